@@ -0,0 +1,72 @@
+import json
+import platform
+import subprocess
+import sys
+from argparse import ArgumentParser
+from time import time
+
+from bench.suites import SUITES
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+
+def parse_args():
+    ap = ArgumentParser(description="toki benchmarks")
+    ap.add_argument('suites', nargs='*', metavar="suite", help=f"suites to run (default: all of {', '.join(SUITES)})")
+    ap.add_argument('-s', dest="sizes", type=int, nargs='+', default=DEFAULT_SIZES, metavar="n", help="vault sizes / event counts")
+    ap.add_argument('-r', dest="repeat", type=int, default=5, help="repetitions per measurement, the best is kept")
+    ap.add_argument('-o', dest="output", metavar="file", help="write JSON results to <file>")
+    ap.add_argument('--compare', dest="compare", metavar="file", help="compare with the results in <file>")
+    args = ap.parse_args()
+    unknown = set(args.suites) - set(SUITES)
+    if unknown:
+        ap.error(f"unknown suite(s): {', '.join(sorted(unknown))}")
+    return args
+
+def revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(old: dict, new: dict) -> None:
+    # timing fields end in _s; print new/old for rows that line up
+    for name, rows in new['results'].items():
+        for old_row, new_row in zip(old['results'].get(name, []), rows):
+            for field, value in new_row.items():
+                base = old_row.get(field)
+                if field.endswith('_s') and value and base:
+                    label = ' '.join(f"{k}={v}" for k, v in new_row.items() if not isinstance(v, float) and k != field)
+                    print(f"{name:8} {label:40} {field:16} {base:.6f} -> {value:.6f} ({value / base:.2f}x)")
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = {
+        'meta': {
+            'revision': revision(),
+            'time': time(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'sizes': args.sizes,
+            'repeat': args.repeat,
+        },
+        'results': {},
+    }
+    for name in args.suites or SUITES:
+        print(f"running {name}", file=sys.stderr)
+        report['results'][name] = SUITES[name](args.sizes, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+    # rows that carry a budget (cold_start) fail the run when they're over it
+    over = [row for rows in report['results'].values() for row in rows if row.get('within_budget') is False]
+    for row in over:
+        print(f"over budget: {row}", file=sys.stderr)
+    sys.exit(1 if over else 0)
@@ -0,0 +1,179 @@
+import json
+import os
+import runpy
+import tempfile
+from argparse import ArgumentParser
+from base64 import b32encode
+from collections import Counter
+from hashlib import sha1
+from time import perf_counter, sleep
+from typing import Any, Optional
+
+from toki.events import DEFAULT_MAXSIZE, DEFAULT_POLICIES, Event, EventSystem, GlobalEvents
+from toki.instrument import STATS
+from toki.keyfile import JournaledKeyFile
+from toki.trace import INPUT_EVENTS, VirtualClock, read_trace
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPLAY_PASSPHRASE = 'replay'
+# smallest virtual time step, in case a job is due again straight away
+MIN_STEP = 0.001
+# longest real sleep in a realtime replay
+REALTIME_POLL = 0.01
+
+# Stands in for toki.ui.UI, so the Application runs without a display. The
+# replay only measures the application side; nothing subscribes for the UI.
+class StubUI:
+    def title(self, *args, **kwargs) -> None:
+        pass
+
+    def geometry(self, *args, **kwargs) -> None:
+        pass
+
+    def bind(self, *args, **kwargs) -> None:
+        pass
+
+    def mainloop(self) -> None:
+        pass
+
+    def destroy(self) -> None:
+        pass
+
+def load_application() -> type:
+    # toki.pyw isn't importable as a module
+    return runpy.run_path(os.path.join(REPO_ROOT, 'toki.pyw'), run_name='toki_replay')['Application']
+
+def synthetic_secret(placeholder: str) -> str:
+    return b32encode(sha1(placeholder.encode()).digest()[:10]).decode()
+
+# Feeds a trace recorded with TOKI_TRACE=<path> through the real Application,
+# Tk stubbed out and time virtual. Only the user's input events are published;
+# codes, list updates, timer ticks etc. come from the application again, driven
+# by its scheduler on the virtual clock. The vault is rebuilt from the first
+# TOTP_LIST in the trace, with the recorded placeholders as entry names, and the
+# password that unlocked it becomes REPLAY_PASSPHRASE.
+# By default virtual time jumps straight to the next deadline or input; with
+# realtime=True the replay sleeps for real in between, at the recorded speed.
+class Replay:
+    def __init__(self, path: str, realtime: bool = False, keyfile_dir: Optional[str] = None):
+        self.path = path
+        self.realtime = realtime
+        self.header, records = read_trace(path)
+        self.records = list(records)
+        self.clock = VirtualClock(self.header['start'])
+        self.events = EventSystem(DEFAULT_MAXSIZE, DEFAULT_POLICIES, threaded=False)
+        self.published = Counter()
+        self.events.tap = lambda name, data: self.published.update((name,))
+        self._keyfile_dir = keyfile_dir
+        self._password = self._unlocking_password()
+        self._app = None
+
+    def _unlocking_password(self) -> Optional[str]:
+        # the last password entered before the list first appeared is the right one
+        password = None
+        for _, name, data in self.records:
+            if name == Event.PASSWORD:
+                password = data
+            elif name == Event.TOTP_LIST:
+                return password
+        return None
+
+    def _vault(self) -> dict:
+        for _, name, data in self.records:
+            if name == Event.TOTP_LIST:
+                return {placeholder:synthetic_secret(placeholder) for placeholder in data}
+        return {}
+
+    def _payload(self, name: str, data: Any) -> Any:
+        if name == Event.PASSWORD:
+            return REPLAY_PASSPHRASE if data == self._password else f"wrong{data}"
+        if name == Event.ADD_TOTP:
+            return (data[0], synthetic_secret(data[0]))
+        return tuple(data) if isinstance(data, list) else data
+
+    def run(self) -> dict:
+        with tempfile.TemporaryDirectory(dir=self._keyfile_dir) as tmp:
+            keyfile = os.path.join(tmp, 'replay.keys')
+            JournaledKeyFile(keyfile, REPLAY_PASSPHRASE, create_file=True).write_keys(self._vault())
+            saved_events, saved_stats = GlobalEvents.event_system, STATS.enabled
+            GlobalEvents.event_system = self.events
+            STATS.reset()
+            STATS.enabled = True
+            try:
+                return self._run(keyfile)
+            finally:
+                STATS.enabled = saved_stats
+                GlobalEvents.event_system = saved_events
+
+    def _run(self, keyfile: str) -> dict:
+        app = self._app = load_application()([keyfile], clock=self.clock, ui=StubUI())
+        dispatched = inputs = 0
+        start = perf_counter()
+        try:
+            for offset, name, data in self.records:
+                dispatched += self._advance_to(self.header['start'] + offset)
+                if name not in INPUT_EVENTS or name == Event.MENU_EXIT:
+                    continue
+                self.events.publish(name, self._payload(name, data))
+                inputs += 1
+                dispatched += self.events.drain()
+                if name == Event.PASSWORD and app._unlocker is not None and not self.realtime:
+                    # keeps fast replays deterministic: the unlock finishes before
+                    # the next input, whatever the KDF costs on this machine
+                    app._unlocker.join()
+                    dispatched += self.events.drain()
+            if app._unlocker is not None:
+                app._unlocker.join()
+            dispatched += self.events.drain()
+            elapsed = perf_counter() - start
+        finally:
+            app.vaults.stop()
+            app.codes.zeroize()
+        stats = STATS.snapshot()
+        recorded = Counter(name for _, name, _ in self.records)
+        return {
+            'trace': self.path,
+            'mode': 'realtime' if self.realtime else 'fast',
+            'virtual_s': self.clock.time() - self.header['start'],
+            'elapsed_s': elapsed,
+            'inputs': inputs,
+            'dispatched': dispatched,
+            'events_per_sec': dispatched / elapsed if elapsed else None,
+            'events': {name:{'recorded': recorded.get(name, 0), 'replayed': self.published.get(name, 0)} for name in sorted(set(recorded) | set(self.published))},
+            # queue wait before dispatch and time in each subscriber, real seconds
+            'latency': stats.get('event_wait', {}),
+            'subscribers': stats.get('subscriber', {}),
+        }
+
+    def _advance_to(self, target: float) -> int:
+        # runs the scheduler up to target, deadline by deadline, dispatching
+        # whatever each pass publishes; returns the number of events dispatched
+        dispatched = 0
+        while True:
+            wait = self._app.scheduler.run_pending()
+            dispatched += self.events.drain()
+            remaining = target - self.clock.time()
+            if remaining <= 0:
+                return dispatched
+            step = min(max(wait, MIN_STEP), remaining)
+            if self.realtime:
+                # short sleeps, so what the unlock thread publishes is picked up promptly
+                step = min(step, REALTIME_POLL)
+                sleep(step)
+            self.clock.advance(step)
+
+def parse_args():
+    ap = ArgumentParser(description="replay a toki event trace (recorded with TOKI_TRACE=<file>)")
+    ap.add_argument('trace', help="trace file")
+    ap.add_argument('--realtime', action='store_true', help="replay at the recorded speed instead of as fast as possible")
+    ap.add_argument('-o', dest="output", metavar="file", help="write the JSON report to <file>")
+    return ap.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = Replay(args.trace, realtime=args.realtime).run()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
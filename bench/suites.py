@@ -0,0 +1,283 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from base64 import b32encode
+from threading import Event as ThreadEvent
+from time import perf_counter
+from typing import Callable, Dict, List
+
+from toki.codes import CodeEngine
+from toki.events import Event, EventSystem
+from toki.keyfile import FORMATS, KeyFile, pass2key
+from toki.prop_helpers import DottedDict, NestedPropertiesDict, PropertyHandle
+from toki.trace import TraceRecorder, VirtualClock
+from toki.verify import Verifier
+
+SUITES: Dict[str, Callable] = {}
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules toki.pyw pulls in before the password window appears
+STARTUP_MODULES = ['toki.codes', 'toki.events', 'toki.keyfile', 'toki.otpauth', 'toki.persist', 'toki.scheduler', 'toki.ui']
+
+# import time of each entry point (module level only, no window or prompt is
+# created), in seconds over a bare interpreter. these are checked, not just
+# reported: heavy dependencies must stay deferred and no threads may be running yet
+COLD_START_BUDGETS = {
+    'toki.pyw': 0.25,
+    'toki_cli.py': 0.15,
+}
+COLD_START_DEFERRED = ('cryptography', 'clipboard', 'pyperclip', 'asyncio')
+COLD_START_PROBE = '''
+import json, runpy, sys, threading
+runpy.run_path({path!r}, run_name='__cold_start__')
+print(json.dumps({{
+    'loaded': [m for m in {deferred!r} if m in sys.modules],
+    'threads': threading.active_count(),
+}}))
+'''
+
+def suite(func: Callable) -> Callable:
+    SUITES[func.__name__] = func
+    return func
+
+def synthetic_vault(size: int, seed: int = 0) -> dict:
+    # deterministic so runs on different revisions use the same vault
+    return {f"issuer{i % 97}:account{seed}-{i}": b32encode(i.to_bytes(10, 'big')).decode() for i in range(size)}
+
+def best_of(func: Callable, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+    return best
+
+def peak_memory(func: Callable) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+@suite
+def keyfile(sizes: List[int], repeat: int) -> List[dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for format in FORMATS:
+            for size in sizes:
+                keys = synthetic_vault(size)
+                with redirect_stdout(sys.stderr):
+                    kf = KeyFile(os.path.join(tmp, f"bench.{format}.keys"), 'benchmark', create_file=True, format=format)
+                kf.write_keys(keys)
+                # the session key is cached after the first call, so this times I/O + crypto only
+                results.append({
+                    'format': format,
+                    'entries': size,
+                    'bytes': os.path.getsize(kf._filepath),
+                    'read_s': best_of(kf.read_keys, repeat),
+                    'write_s': best_of(lambda: kf.write_keys(keys), repeat),
+                    'read_peak_bytes': peak_memory(kf.read_keys),
+                    'write_peak_bytes': peak_memory(lambda: kf.write_keys(keys)),
+                })
+    return results
+
+@suite
+def kdf(sizes: List[int], repeat: int) -> List[dict]:
+    salt = os.urandom(16)
+    return [{'iterations': iterations, 'derive_s': best_of(lambda: pass2key('benchmark', salt, iterations), repeat)}
+            for iterations in (10000, 100000, 600000)]
+
+def engine_memory(keys: dict) -> int:
+    # what a CodeEngine holds on to once built, not the peak while building it
+    tracemalloc.start()
+    try:
+        engine = CodeEngine(keys)
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+@suite
+def codes(sizes: List[int], repeat: int) -> List[dict]:
+    results = []
+    for size in sizes:
+        keys = synthetic_vault(size)
+        engine = CodeEngine(keys)
+        steps = iter(range(10 ** 9))
+        # a new step every call so nothing comes from the cache
+        batch = best_of(lambda: engine.codes(next(steps) * engine.interval), repeat)
+        results.append({
+            'entries': size,
+            'decode_s': best_of(lambda: CodeEngine(keys), repeat),
+            'batch_s': batch,
+            'codes_per_sec': size / batch if batch else None,
+            'cached_s': best_of(engine.codes, repeat),
+            'engine_bytes_per_entry': engine_memory(keys) / size,
+        })
+    return results
+
+@suite
+def verify(sizes: List[int], repeat: int) -> List[dict]:
+    results = []
+    for size in sizes:
+        keys = synthetic_vault(size)
+        engine = CodeEngine(keys)
+        # a fresh verifier and step per run, so every code is new and nothing is a replay
+        runs = iter([(Verifier(keys), list(engine.codes(step * engine.interval).items()), step * engine.interval) for step in range(1, repeat + 1)])
+        def burst() -> None:
+            verifier, attempts, now = next(runs)
+            verifier.verify_many(attempts, now)
+        elapsed = best_of(burst, repeat)
+        results.append({
+            'users': size,
+            'burst_s': elapsed,
+            'verifications_per_sec': size / elapsed if elapsed else None,
+        })
+    return results
+
+@suite
+def events(sizes: List[int], repeat: int) -> List[dict]:
+    results = []
+    for size in sizes:
+        es = EventSystem()
+        latencies = []
+        done = ThreadEvent()
+        def consumer(sent: float) -> None:
+            latencies.append(perf_counter() - sent)
+            if len(latencies) == size:
+                done.set()
+        es.subscribe('bench', consumer)
+        start = perf_counter()
+        for _ in range(size):
+            es.publish('bench', perf_counter())
+        done.wait()
+        elapsed = perf_counter() - start
+        es.stop()
+        latencies.sort()
+        results.append({
+            'events': size,
+            'events_per_sec': size / elapsed,
+            'latency_p50_s': latencies[len(latencies) // 2],
+            'latency_p99_s': latencies[int(len(latencies) * 0.99)],
+            'latency_max_s': latencies[-1],
+        })
+    return results
+
+@suite
+def props(sizes: List[int], repeat: int) -> List[dict]:
+    # per-read cost of the paths the totp frame reads on every update, against a
+    # plain attribute chain; sizes are reads per run
+    class Plain:
+        pass
+    plain = Plain()
+    plain.totp = Plain()
+    plain.totp.progress = object()
+    nested = NestedPropertiesDict()
+    nested.totp.progress = plain.totp.progress
+    dotted = DottedDict()
+    dotted['totp.progress'] = plain.totp.progress
+    handle = PropertyHandle(nested, 'totp.progress')
+    results = []
+    for size in sizes:
+        loop = range(size)
+        def attribute() -> None:
+            for _ in loop:
+                plain.totp.progress
+        def nested_attribute() -> None:
+            for _ in loop:
+                nested.totp.progress
+        def dotted_key() -> None:
+            for _ in loop:
+                dotted['totp.progress']
+        def resolved_handle() -> None:
+            for _ in loop:
+                handle.get()
+        row = {'reads': size}
+        for name, func in (('attribute', attribute), ('nested', nested_attribute), ('dotted', dotted_key), ('handle', resolved_handle)):
+            row[f"{name}_ns"] = best_of(func, repeat) / size * 1e9
+        results.append(row)
+    return results
+
+def synthetic_trace(path: str, keys: dict, seconds: float = 95.0) -> None:
+    # a session shaped like the ones that hurt: unlock, some browsing, a burst
+    # of adds, a copy, across a few step rollovers. written with the recorder
+    # itself so it is redacted the same way a real trace is
+    clock = VirtualClock(1_700_000_000.0)
+    recorder = TraceRecorder(path, clock.time)
+    names = list(keys)
+    at = lambda offset, name, data=None: (clock.advance_to(recorder.start + offset), recorder(name, data))
+    at(0.5, Event.PASSWORD, 'wrong password')
+    at(2.0, Event.PASSWORD, 'password')
+    at(2.4, Event.TOTP_LIST, names)
+    for i, name in enumerate(names[:20]):
+        at(5.0 + i * 0.25, Event.TOTP_SELECTED, name)
+    for i in range(50):
+        at(28.0 + i * 0.02, Event.ADD_TOTP, (f"added-{i}", b32encode(i.to_bytes(10, 'big')).decode()))
+    at(40.0, Event.COPY_TOTP)
+    at(61.0, Event.MENU_REMOVE_TOTP)
+    at(61.5, Event.REMOVE_TOTP, 'added-0')
+    at(seconds, Event.TOTP_SELECTED, names[-1])
+    recorder.close()
+
+@suite
+def replay(sizes: List[int], repeat: int) -> List[dict]:
+    # replays a synthetic trace through the application, fast, and reports real
+    # time spent per virtual session plus dispatch latency
+    from bench.replay import Replay
+    results = []
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace')
+            synthetic_trace(path, synthetic_vault(size))
+            with redirect_stdout(sys.stderr):
+                report = Replay(path, keyfile_dir=tmp).run()
+        waits = report['latency'].values()
+        results.append({
+            'entries': size,
+            'virtual_s': report['virtual_s'],
+            'elapsed_s': report['elapsed_s'],
+            'events_per_sec': report['events_per_sec'],
+            'wait_mean_s': sum(w['total_s'] for w in waits) / max(1, sum(w['count'] for w in waits)),
+            'wait_max_s': max((w['max_s'] for w in waits), default=0.0),
+        })
+    return results
+
+@suite
+def startup(sizes: List[int], repeat: int) -> List[dict]:
+    # each import in a fresh interpreter, minus the cost of starting one
+    run = lambda code: subprocess.run([sys.executable, '-c', code], cwd=REPO_ROOT, capture_output=True)
+    baseline = best_of(lambda: run('pass'), repeat)
+    results = []
+    for module in STARTUP_MODULES:
+        if run(f"import {module}").returncode != 0:
+            results.append({'module': module, 'import_s': None, 'error': 'import failed'})
+            continue
+        results.append({'module': module, 'import_s': best_of(lambda: run(f"import {module}"), repeat) - baseline})
+    return results
+
+@suite
+def cold_start(sizes: List[int], repeat: int) -> List[dict]:
+    run = lambda code: subprocess.run([sys.executable, '-c', code], cwd=REPO_ROOT, capture_output=True, text=True)
+    baseline = best_of(lambda: run('pass'), repeat)
+    results = []
+    for path, budget in COLD_START_BUDGETS.items():
+        probe = COLD_START_PROBE.format(path=path, deferred=COLD_START_DEFERRED)
+        proc = run(probe)
+        if proc.returncode != 0:
+            results.append({'entry': path, 'start_s': None, 'budget_s': budget, 'within_budget': False, 'error': proc.stderr.strip().splitlines()[-1:]})
+            continue
+        found = json.loads(proc.stdout)
+        elapsed = best_of(lambda: run(probe), repeat) - baseline
+        results.append({
+            'entry': path,
+            'start_s': elapsed,
+            'budget_s': budget,
+            'eager_imports': found['loaded'],
+            'threads': found['threads'],
+            'within_budget': elapsed <= budget and not found['loaded'] and found['threads'] == 1,
+        })
+    return results
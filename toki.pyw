@@ -1,25 +1,44 @@
 from contextlib import suppress
-from os import path
+import sys
+from functools import partial
 from threading import Thread
-from time import sleep, time
+from time import time
 from traceback import print_exc
-from typing import Any, Callable, Dict, List, Union, Tuple
-
-import clipboard
-from pyotp import TOTP
+from typing import Any, Callable, Dict, List, Optional, Union, Tuple
 
+from toki.codes import CodeEngine, Entry, compact_entry, entry_secret
 from toki.events import Event, EventSystem, GlobalEvents
-from toki.keyfile import CanNotDecrypt, KeyFile
+from toki.keyfile import CanNotDecrypt
+from toki.otpauth import parse_uri
+from toki.scheduler import Scheduler
 from toki.ui import UI
 from toki.util import first
+from toki.vaults import VaultSet
 
 DEFAULT_KEYFILE = './.totp.keys'
+# progress bar updates per second while the totp frame is showing
+PROGRESS_REFRESH_RATE = 5.0
+# seconds between checks for keyfile changes made by other toki instances
+WATCH_INTERVAL = 2.0
 
 class Application:
-    def __init__(self):
-        self.keyfile = None
+    def __init__(self, keyfiles: Optional[List[str]] = None, progress_refresh_rate: float = PROGRESS_REFRESH_RATE, clock: Optional[Any] = None, ui: Optional[Any] = None):
+        # with a clock (a toki.trace.VirtualClock) nothing runs by itself: the
+        # scheduler isn't started and whoever owns the clock drives it, see bench.replay
+        self.clock = clock
+        # every keyfile is unlocked with the same password; with more than one,
+        # entries are listed as <vault>/<name>
+        self.codes = CodeEngine(clock=clock.time if clock else time)
+        # the engine's store is the only copy of the secrets; the vaults take
+        # what they write from it
+        self.vaults = VaultSet(keyfiles or [DEFAULT_KEYFILE], write_behind=True, source=self.codes.entries, on_write_error=self._on_write_error)
+        self._unlocker = None
+        # set once a load_totps_file has gone all the way through; until then a
+        # password unlocks rather than re-keys, whatever the vaults say
+        self._loaded = False
+        # periods with a ('step', period) job in the scheduler
+        self._step_periods = set()
         self.events = GlobalEvents()
-        self.totps = {}
         self.current_totp_name = None
         self.events = GlobalEvents.get_event_system()
         self.events.subscribe(Event.PASSWORD, self.handle_on_password)
@@ -29,92 +48,198 @@ class Application:
         self.events.subscribe(Event.MENU_SHOW_TOTP, self.handle_show_totp)
         self.events.subscribe(Event.COPY_TOTP, self.handle_copy_totp)
         self.events.subscribe(Event.MENU_EXIT, self.exit)
-        self.ui = UI()
+        self.events.subscribe(Event.KEYFILE_CHANGED, self.handle_keyfile_changed)
+        self.events.subscribe(Event.TOTP_LIST, lambda e: self.set_totps_visible(True))
+        self.events.subscribe(Event.SHOW_TOTP_FRAME, lambda e: self.set_totps_visible(True))
+        self.events.subscribe(Event.MENU_ADD_TOTP, lambda e: self.set_totps_visible(False))
+        self.events.subscribe(Event.MENU_CHANGE_PASSWORD, lambda e: self.set_totps_visible(False))
+        self.ui = ui if ui is not None else UI()
         self.ui.title(f"Toki")
         self.ui.geometry("256x384")
+        self.ui.bind('<Map>', lambda e: e.widget is self.ui and self.set_window_visible(True))
+        self.ui.bind('<Unmap>', lambda e: e.widget is self.ui and self.set_window_visible(False))
         self.running = True
-        self._timer_thread = Thread(None, self._timer_thread, daemon=True)
-        self._timer_thread.start()
-
-    def _timer_thread(self) -> None:
-        while self.running:
-            try:
-                if (time() % 30) < 1.0 and self.current_totp_name in self.totps:
-                    self.events.publish(Event.TOTP_UPDATE, (self.current_totp_name, self.totps[self.current_totp_name].now()))
-                self.events.publish(Event.TIMER_UPDATE, time() % 30 / 30)
-            except Exception as ex:
-                print("Exception in timer thread")
-                print_exc()
-            finally:
-                sleep(0.2)
+        self._totps_visible = False
+        self._window_visible = True
+        self.scheduler = Scheduler(clock.time, clock.monotonic) if clock else Scheduler()
+        self.scheduler.every('progress', 1 / progress_refresh_rate, self._on_progress, paused=True)
+
+    def _schedule_steps(self) -> None:
+        # one deadline per distinct period in the vault; periods no entry uses
+        # any more are dropped, the others keep their job as it is
+        periods = set(self.codes.periods() or (self.codes.interval,))
+        for period in self._step_periods - periods:
+            self.scheduler.cancel(('step', period))
+        for period in periods - self._step_periods:
+            self.scheduler.at_step(('step', period), period, partial(self._on_step, period))
+        self._step_periods = periods
+
+    def _on_step(self, period: float, step: int) -> None:
+        self.events.publish(Event.TOTP_CODES, self.codes.codes())
+        name = self.current_totp_name
+        if name in self.codes and self.codes.period(name) == period:
+            self.events.publish(Event.TOTP_UPDATE, (name, self.codes.code(name)))
+
+    def _on_watch(self, now: float) -> None:
+        # a stat() per vault; the reload itself happens on the event thread
+        for name in self.vaults.changed():
+            self.events.publish(Event.KEYFILE_CHANGED, name)
+
+    def _on_progress(self, now: float) -> None:
+        period = self.codes.period(self.current_totp_name) if self.current_totp_name in self.codes else self.codes.interval
+        self.events.publish(Event.TIMER_UPDATE, now % period / period)
+
+    def set_totps_visible(self, visible: bool) -> None:
+        self._totps_visible = visible
+        self._update_progress_timer()
+
+    def set_window_visible(self, visible: bool) -> None:
+        self._window_visible = visible
+        self._update_progress_timer()
+
+    def _update_progress_timer(self) -> None:
+        if self._totps_visible and self._window_visible:
+            self.scheduler.resume('progress')
+        else:
+            self.scheduler.pause('progress')
+
+    @property
+    def unlocked(self) -> bool:
+        return bool(self.vaults.unlocked)
 
     def handle_on_password(self, password: str, *args, **kwargs) -> None:
-        # change password if keyfile is already loaded
-        if self.keyfile:
-            keyfile = KeyFile(DEFAULT_KEYFILE, password, create_file=True)
-            totps = keyfile.write_keys({name:totp.secret for name, totp in self.totps.items()})
-            self.keyfile = keyfile
-            self.events.publish(Event.SHOW_TOTP_FRAME)
-        elif self.load_totps_file(password):
-            self.events.publish(Event.TOTP_LIST, list(self.totps.keys()))
-            self.handle_totp_selected(first(self.totps))
+        # the KDF runs once per vault, keep it off the event thread
+        if self._unlocker and self._unlocker.is_alive():
+            return
+        self._unlocker = Thread(None, self._unlock, args=(password,), daemon=True)
+        self._unlocker.start()
+
+    def _unlock(self, password: str) -> None:
+        try:
+            # change password if the vaults are already loaded
+            if self._loaded:
+                self.vaults.rekey(password)
+                self.events.publish(Event.SHOW_TOTP_FRAME)
+            elif self.load_totps_file(password):
+                self.publish_totp_list()
+                self.handle_totp_selected(first(self.codes.store))
+        except Exception:
+            print("Exception unlocking keyfiles")
+            print_exc()
+
+    def _on_write_error(self, vault_name: str, error: Exception) -> None:
+        # the writer keeps the edits and retries, the UI tells the user
+        self.events.publish(Event.KEYFILE_WRITE_FAILED, (vault_name, str(error) or type(error).__name__))
+
+    def _on_unlock_progress(self, name: str, done: int, total: int, ok: bool) -> None:
+        self.events.publish(Event.UNLOCK_PROGRESS, (name, done, total, ok))
+
+    def report_invalid(self, names: List[str]) -> None:
+        # kept in the keyfile as they are, just without a code
+        for name in names:
+            print(f"skipping {name}: not a valid secret")
+
+    def publish_totp_list(self) -> None:
+        self.events.publish(Event.TOTP_LIST, list(self.codes.store))
+        self.events.publish(Event.TOTP_CODES, self.codes.codes())
 
     def handle_totp_selected(self, name: str, *args, **kwargs) -> None:
-        if name in self.totps:
-            totp = self.totps[name]
+        if name in self.codes:
             self.current_totp_name = name
-            self.events.publish(Event.TOTP_UPDATE, (name, totp.now()))
+            self.events.publish(Event.TOTP_UPDATE, (name, self.codes.code(name)))
 
     def handle_add_totp(self, totp: Tuple[str, str], *args, **kwargs) -> None:
-        if not self.keyfile:
+        if not self.unlocked:
             return
 
         name, secret = totp
-        self.totps[name] = TOTP(secret)
-        self.keyfile.write_keys({n:t.secret for n,t in self.totps.items()})
-        self.events.publish(Event.TOTP_LIST, list(self.totps.keys()))
+        if secret.strip().startswith('otpauth://'):
+            label, entry = parse_uri(secret)
+            name = name or label
+        else:
+            entry = compact_entry(secret)
+        name, = self.vaults.update([(name, entry)])
+        self.codes.add(name, entry)
+        self._schedule_steps()
+        self.publish_totp_list()
+
+    def handle_keyfile_changed(self, vault_name: str, *args, **kwargs) -> None:
+        if not self.unlocked:
+            return
+
+        try:
+            changes = self.vaults.reload(vault_name)
+        except CanNotDecrypt:
+            # re-encrypted under another password elsewhere, keep what we have
+            print(f"keyfile for {vault_name} can no longer be decrypted, not watching it")
+            return
+        if not changes:
+            return
+        self.report_invalid(self.codes.merge(changes))
+        self._schedule_steps()
+        self.publish_totp_list()
+        if self.current_totp_name not in self.codes:
+            self.handle_totp_selected(first(self.codes.store))
 
     def handle_show_totp(self, *args, **kwargs) -> None:
-        if not self.keyfile or not self.current_totp_name in self.totps:
+        if not self.unlocked or not self.current_totp_name in self.codes:
             return
-        self.events.publish(Event.SHOW_TOTP, (self.current_totp_name, self.totps[self.current_totp_name].secret))
+        self.events.publish(Event.SHOW_TOTP, (self.current_totp_name, entry_secret(self.codes.entry(self.current_totp_name))))
 
 
     def handle_remove_totp(self, name: str, *args, **kwargs) -> None:
-        if not self.keyfile or name == None:
+        if not self.unlocked or name == None:
             return
 
-        del self.totps[name]
-        self.keyfile.write_keys({n:t.secret for n,t in self.totps.items()})
-        self.events.publish(Event.TOTP_LIST, list(self.totps.keys()))
+        self.vaults.update([(name, None)])
+        self.codes.remove(name)
+        self._schedule_steps()
+        self.publish_totp_list()
 
     def handle_copy_totp(self, *args, **kwargs) -> None:
         if not self.current_totp_name:
             return
 
-        clipboard.copy(self.totps[self.current_totp_name].now())
+        # the UI does the copy on the Tk thread, see toki.clip
+        self.events.publish(Event.CLIPBOARD_COPY, self.codes.code(self.current_totp_name))
 
     def start(self) -> None:
         self.ui.mainloop()
 
     def exit(self, *args, **kwargs) -> None:
+        self.vaults.stop()
+        self.codes.zeroize()
         self.ui.destroy()
         self.running = False
+        self.scheduler.stop()
         self.events.stop()
         exit()
 
     def load_totps_file(self, password: str) -> bool:
-        keyfile = KeyFile(DEFAULT_KEYFILE, password, create_file=not path.isfile(DEFAULT_KEYFILE))
-        try:
-            totps = keyfile.read_keys()
-            self.totps = {name:TOTP(totp) for name, totp in totps.items()}
-            self.keyfile = keyfile
-            return True
-        except CanNotDecrypt:
+        # all vaults are unlocked side by side; any the password doesn't open stay locked
+        # the vaults only count as unlocked once the engine holds their entries,
+        # since that's what gets written back from then on
+        self.vaults.unlock(password, self._on_unlock_progress, load=self._load_secrets)
+        if not self.unlocked:
             return False
+        self._schedule_steps()
+        self.scheduler.every('watch', WATCH_INTERVAL, self._on_watch)
+        # nothing is scheduled to run before the first unlock
+        if self.clock is None:
+            self.scheduler.start()
+        self._loaded = True
+        return True
+
+    def _load_secrets(self, entries: Dict[str, Entry]) -> None:
+        try:
+            self.report_invalid(self.codes.set_secrets(entries))
+        except BaseException:
+            # don't leave a partial vault behind
+            self.codes.zeroize()
+            raise
 
 
 if __name__ == "__main__":
     print('starting up')
-    app = Application()
+    app = Application(sys.argv[1:] or [DEFAULT_KEYFILE])
     app.start()
@@ -0,0 +1,194 @@
+import json
+import os
+import socket
+import struct
+import tempfile
+from contextlib import suppress
+from time import monotonic
+from typing import Optional
+
+from toki.codes import CodeEngine
+from toki.instrument import STATS
+from toki.keyfile import KeyFile
+
+DEFAULT_IDLE_TIMEOUT = 15 * 60
+MAX_REQUEST_SIZE = 4096
+
+class AgentUnavailable(Exception):
+    pass
+
+class AgentError(Exception):
+    pass
+
+def default_socket_path() -> str:
+    if 'TOKI_AGENT_SOCK' in os.environ:
+        return os.environ['TOKI_AGENT_SOCK']
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir()), f"toki-agent-{os.getuid()}.sock")
+
+# Holds an unlocked vault in memory and answers requests over a Unix socket,
+# one JSON object per line each way:
+#   {"op": "code", "name": ...} -> {"ok": true, "code": ..., "remaining": ...}
+#   {"op": "list"}              -> {"ok": true, "names": [...]}
+#   {"op": "lock"}              -> {"ok": true}, then the agent drops its keys and exits
+#   {"op": "stats"}             -> {"ok": true, "stats": {...}} (see toki.instrument)
+# The agent also locks itself after idle_timeout seconds without a request.
+class Agent:
+    def __init__(self, keyfile: KeyFile, socket_path: Optional[str] = None, idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+        self.keyfile = keyfile
+        self.socket_path = socket_path or default_socket_path()
+        self.idle_timeout = idle_timeout
+        self.codes = None
+        self._last_used = monotonic()
+        self._server = None
+        self._locked = None
+        # connected clients, closed before the server on lock
+        self._clients = set()
+
+    def unlock(self) -> None:
+        self.codes = CodeEngine(self.keyfile.read_keys())
+
+    def run(self) -> None:
+        # asyncio is imported here rather than at the top, agent_request() clients
+        # are plain sockets and shouldn't pay for it
+        import asyncio
+        asyncio.run(self.serve())
+
+    async def serve(self) -> None:
+        import asyncio
+        if self.codes is None:
+            self.unlock()
+        self._locked = asyncio.Event()
+        self._prepare_socket_path()
+        # the socket is created 0600 from the start rather than chmod'ed afterwards
+        umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(self._handle_client, path=self.socket_path, limit=MAX_REQUEST_SIZE)
+        finally:
+            os.umask(umask)
+        print(f"toki agent listening on {self.socket_path}")
+        watchdog = asyncio.create_task(self._idle_watchdog())
+        try:
+            await self._locked.wait()
+        finally:
+            watchdog.cancel()
+            # a client still connected would otherwise have its handler cancelled
+            # mid-read when the loop shuts down
+            for writer in list(self._clients):
+                writer.close()
+            self._server.close()
+            await self._server.wait_closed()
+            with suppress(FileNotFoundError):
+                os.unlink(self.socket_path)
+
+    def lock(self) -> None:
+        if self.codes is not None:
+            self.codes.zeroize()
+        self.codes = None
+        self.keyfile.lock()
+        if self._locked is not None:
+            self._locked.set()
+
+    def _prepare_socket_path(self) -> None:
+        if not os.path.exists(self.socket_path):
+            return
+        try:
+            agent_request({'op': 'list'}, self.socket_path)
+        except AgentUnavailable:
+            # stale socket from an agent that didn't shut down cleanly
+            os.unlink(self.socket_path)
+        else:
+            raise AgentError(f"an agent is already listening on {self.socket_path}")
+
+    async def _idle_watchdog(self) -> None:
+        import asyncio
+        while True:
+            remaining = self._last_used + self.idle_timeout - monotonic()
+            if remaining <= 0:
+                print("toki agent idle, locking")
+                self.lock()
+                return
+            await asyncio.sleep(remaining)
+
+    async def _handle_client(self, reader: 'asyncio.StreamReader', writer: 'asyncio.StreamWriter') -> None:
+        import asyncio
+        self._clients.add(writer)
+        try:
+            if not same_user(writer.get_extra_info('socket')):
+                return
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # request longer than MAX_REQUEST_SIZE
+                    break
+                if not line:
+                    break
+                with STATS.timer('agent', 'request'):
+                    response = self.handle_request(line)
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+    def handle_request(self, line: bytes) -> dict:
+        self._last_used = monotonic()
+        try:
+            request = json.loads(line)
+            op = request['op']
+        except (ValueError, KeyError, TypeError):
+            return {'ok': False, 'error': 'malformed request'}
+
+        if op == 'stats':
+            return {'ok': True, 'stats': STATS.snapshot()}
+        if self.codes is None:
+            return {'ok': False, 'error': 'locked'}
+        if op == 'code':
+            name = request.get('name')
+            if not isinstance(name, str) or name not in self.codes:
+                return {'ok': False, 'error': f"no such OTP {name}"}
+            return {'ok': True, 'code': self.codes.code(name), 'remaining': self.codes.remaining(period=self.codes.period(name))}
+        if op == 'list':
+            return {'ok': True, 'names': list(self.codes.codes())}
+        if op == 'lock':
+            self.lock()
+            return {'ok': True}
+        return {'ok': False, 'error': f"unknown op {op}"}
+
+def same_user(sock: Optional[socket.socket]) -> bool:
+    # the socket file is already 0600, this also guards against a loosened directory
+    if sock is None or not hasattr(socket, 'SO_PEERCRED'):
+        return True
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', creds)
+    return uid == os.getuid()
+
+def agent_request(request: dict, socket_path: Optional[str] = None, timeout: float = 2.0) -> dict:
+    socket_path = socket_path or default_socket_path()
+    # without XDG_RUNTIME_DIR the socket is in the shared temp dir, where anyone
+    # could have put one; never send a request to an agent that isn't ours
+    try:
+        owner = os.stat(socket_path).st_uid
+    except OSError as ex:
+        raise AgentUnavailable(str(ex))
+    if owner != os.getuid():
+        raise AgentError(f"{socket_path} belongs to another user")
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            if not same_user(sock):
+                raise AgentError(f"the agent on {socket_path} runs as another user")
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            with sock.makefile('rb') as f:
+                line = f.readline()
+    except OSError as ex:
+        raise AgentUnavailable(str(ex))
+    if not line:
+        raise AgentUnavailable("agent closed the connection")
+    response = json.loads(line)
+    if not response.get('ok'):
+        raise AgentError(response.get('error', 'unknown error'))
+    return response
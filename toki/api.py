@@ -0,0 +1,123 @@
+from time import sleep, time
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional
+
+from toki.codes import CodeEngine, Entry
+from toki.keyfile import JournaledKeyFile, KeyFile
+
+class CodeUpdate:
+    __slots__ = ('time', 'codes', 'expires')
+
+    def __init__(self, time: float, codes: Dict[str, str], expires: Dict[str, float]):
+        # the step boundary the update is for, the entries whose code changed
+        # there, and when each of those codes is replaced
+        self.time = time
+        self.codes = codes
+        self.expires = expires
+
+    def __repr__(self) -> str:
+        return f"CodeUpdate(time={self.time!r}, codes={sorted(self.codes)!r})"
+
+# UI-free access to a vault's codes for scripts and services:
+#
+#   vault = CodeVault.open('~/.totp.keys', passphrase)
+#   async for update in vault.watch(['github', 'aws']):
+#       ...
+#
+# watch() and watch_sync() first yield every requested code, then sleep until
+# the next step boundary of any of them and yield just the ones whose code
+# changed there; nothing wakes up in between. Codes come from one CodeEngine,
+# whose per-step cache is shared by every consumer, so however many watchers
+# there are each step is computed once.
+class CodeVault:
+    def __init__(self, keys: Dict[str, Entry], clock: Callable[[], float] = time, keyfile: Optional[KeyFile] = None):
+        self.keyfile = keyfile
+        self.engine = CodeEngine(keys, clock=clock)
+        self._clock = clock
+
+    @classmethod
+    def open(cls, filepath: str, passphrase: str, create_file: bool = False) -> 'CodeVault':
+        # raises CanNotDecrypt for a wrong passphrase
+        keyfile = JournaledKeyFile(filepath, passphrase, create_file=create_file)
+        return cls(keyfile.read_keys(), keyfile=keyfile)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.engine
+
+    def __len__(self) -> int:
+        return len(self.engine)
+
+    def names(self) -> List[str]:
+        return list(self.engine.store)
+
+    def codes_at(self, timestamp: float, names: Optional[Iterable[str]] = None) -> Dict[str, str]:
+        # every code (or just names') as of timestamp, in one pass over the vault
+        if names is None:
+            return self.engine.codes(timestamp)
+        return self.engine.codes_for(names, timestamp)
+
+    def close(self) -> None:
+        self.engine.zeroize()
+        if self.keyfile is not None:
+            self.keyfile.lock()
+
+    async def watch(self, names: Optional[Iterable[str]] = None) -> AsyncIterator[CodeUpdate]:
+        # asyncio is only imported by callers that use it
+        import asyncio
+        loop = asyncio.get_running_loop()
+        periods = self._periods(names)
+        if not periods:
+            return
+        last: Dict[str, str] = {}
+        at = self._clock()
+        while True:
+            codes = self.engine.cached(at)
+            if codes is None:
+                # the first watcher to reach a step computes it off the event loop,
+                # the others then find it cached
+                codes = await loop.run_in_executor(None, self.engine.codes, at)
+            update = self._update(periods, at, codes, last)
+            if update is not None:
+                yield update
+            at = self._next_step(periods, at)
+            while (delay := at - self._clock()) > 0:
+                await asyncio.sleep(delay)
+            at = self._catch_up(periods, at)
+
+    def watch_sync(self, names: Optional[Iterable[str]] = None) -> Iterator[CodeUpdate]:
+        periods = self._periods(names)
+        if not periods:
+            return
+        last: Dict[str, str] = {}
+        at = self._clock()
+        while True:
+            update = self._update(periods, at, self.engine.codes(at), last)
+            if update is not None:
+                yield update
+            at = self._next_step(periods, at)
+            while (delay := at - self._clock()) > 0:
+                sleep(delay)
+            at = self._catch_up(periods, at)
+
+    def _periods(self, names: Optional[Iterable[str]]) -> Dict[str, int]:
+        names = self.names() if names is None else list(names)
+        missing = [name for name in names if name not in self.engine]
+        if missing:
+            raise KeyError(f"no such OTP {', '.join(missing)}")
+        return {name:self.engine.period(name) for name in names}
+
+    def _next_step(self, periods: Dict[str, int], at: float) -> float:
+        # the earliest boundary after `at` of any watched entry's period
+        return min(((at // period + 1) * period for period in set(periods.values())), default=float('inf'))
+
+    def _catch_up(self, periods: Dict[str, int], at: float) -> float:
+        # woke up more than a step late (suspend, clock jump): report the step
+        # we're in now rather than every one that was missed
+        now = self._clock()
+        return now if self._next_step(periods, at) <= now else at
+
+    def _update(self, periods: Dict[str, int], at: float, codes: Dict[str, str], last: Dict[str, str]) -> Optional[CodeUpdate]:
+        changed = {name:codes[name] for name in periods if name in codes and last.get(name) != codes[name]}
+        if not changed:
+            return None
+        last.update(changed)
+        return CodeUpdate(at, changed, {name:(at // periods[name] + 1) * periods[name] for name in changed})
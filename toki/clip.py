@@ -0,0 +1,110 @@
+import tkinter as tk
+from threading import Condition, Thread
+from time import monotonic
+from traceback import print_exc
+from typing import Optional
+
+# seconds a copied code stays on the clipboard
+CLEAR_AFTER = 30.0
+
+# Copies through Tk's own clipboard, so a copy is a couple of Tcl calls instead
+# of an xclip/xsel process. Only call it on the Tk thread, e.g. as a UIBridge
+# subscriber. After clear_after seconds the clipboard is cleared, but only if it
+# still holds what we put there; a new copy restarts the one timer.
+class TkClipboard:
+    def __init__(self, root: tk.Misc, clear_after: float = CLEAR_AFTER):
+        self._root = root
+        self.clear_after = clear_after
+        self._copied = None
+        self._timer = None
+        self._fallback = None
+
+    def copy(self, text: str) -> None:
+        try:
+            self._root.clipboard_clear()
+            self._root.clipboard_append(text)
+        except tk.TclError:
+            # no usable clipboard through Tk (e.g. no selection owner support)
+            if self._fallback is None:
+                self._fallback = ClipboardWorker(self.clear_after)
+            self._fallback.copy(text)
+            return
+        self._copied = text
+        if self._timer is not None:
+            self._root.after_cancel(self._timer)
+        self._timer = self._root.after(int(self.clear_after * 1000), self._expire)
+
+    def _expire(self) -> None:
+        self._timer = None
+        self.clear()
+
+    def clear(self) -> None:
+        if self._copied is None:
+            return
+        try:
+            if self._root.clipboard_get() == self._copied:
+                self._root.clipboard_clear()
+        except tk.TclError:
+            # empty, or holds something that isn't text, either way not ours
+            pass
+        self._copied = None
+
+    def close(self) -> None:
+        if self._timer is not None:
+            self._root.after_cancel(self._timer)
+            self._timer = None
+        self.clear()
+        if self._fallback is not None:
+            self._fallback.stop()
+
+# Fallback for when Tk can't be used: the clipboard package (pyperclip on
+# Linux spawns xclip/xsel per call) driven from one long-lived thread, so
+# callers never wait on it. Only the latest pending copy is made.
+class ClipboardWorker:
+    def __init__(self, clear_after: float = CLEAR_AFTER):
+        self.clear_after = clear_after
+        self._cond = Condition()
+        self._pending = None
+        self._copied = None
+        self._clear_at = None
+        self._running = True
+        self._thread = Thread(None, self._worker_thread, name='Clipboard', daemon=True)
+        self._thread.start()
+
+    def copy(self, text: str) -> None:
+        with self._cond:
+            self._pending = text
+            self._cond.notify()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def _timeout(self) -> Optional[float]:
+        return None if self._clear_at is None else max(0.0, self._clear_at - monotonic())
+
+    def _worker_thread(self) -> None:
+        import clipboard
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None or not self._running or (self._clear_at is not None and monotonic() >= self._clear_at), self._timeout())
+                if not self._running:
+                    return
+                text, self._pending = self._pending, None
+                expired = text is None and self._clear_at is not None and monotonic() >= self._clear_at
+                if text is not None:
+                    self._clear_at = monotonic() + self.clear_after
+                elif expired:
+                    self._clear_at = None
+            try:
+                if text is not None:
+                    clipboard.copy(text)
+                    self._copied = text
+                elif expired and self._copied is not None:
+                    if clipboard.paste() == self._copied:
+                        clipboard.copy('')
+                    self._copied = None
+            except Exception:
+                print("Exception in ClipboardWorker")
+                print_exc()
@@ -0,0 +1,356 @@
+import hmac
+from array import array
+from base64 import b32decode, b32encode
+from collections.abc import Mapping
+from struct import pack
+from threading import Lock
+from time import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+DEFAULT_INTERVAL = 30
+DEFAULT_DIGITS = 6
+DEFAULT_ALGORITHM = 'SHA1'
+ALGORITHMS = ('SHA1', 'SHA256', 'SHA512')
+
+# A keyfile entry is either a bare base32 secret (every parameter at its default)
+# or a dict with 'secret' and optionally 'issuer', 'digits', 'period', 'algorithm'.
+Entry = Union[str, dict]
+
+def decode_secret(secret: str) -> bytes:
+    # same normalisation pyotp does: case-insensitive, optional padding
+    secret = secret.replace(' ', '').upper()
+    return b32decode(secret + '=' * (-len(secret) % 8))
+
+def normalize_entry(entry: Entry) -> dict:
+    if isinstance(entry, str):
+        entry = {'secret': entry}
+    if not isinstance(entry, dict) or not isinstance(entry.get('secret'), str) or not entry['secret']:
+        raise ValueError("entry has no secret")
+    normalized = {
+        'secret': entry['secret'].replace(' ', '').upper().rstrip('='),
+        'issuer': entry.get('issuer') or None,
+        'digits': int(entry.get('digits') or DEFAULT_DIGITS),
+        'period': int(entry.get('period') or DEFAULT_INTERVAL),
+        'algorithm': (entry.get('algorithm') or DEFAULT_ALGORITHM).upper(),
+    }
+    decode_secret(normalized['secret'])
+    if not 6 <= normalized['digits'] <= 10:
+        raise ValueError(f"unsupported digits {normalized['digits']}")
+    if normalized['period'] <= 0:
+        raise ValueError(f"unsupported period {normalized['period']}")
+    if normalized['algorithm'] not in ALGORITHMS:
+        raise ValueError(f"unsupported algorithm {normalized['algorithm']}")
+    return normalized
+
+def compact_entry(entry: Entry) -> Entry:
+    # what gets stored in the keyfile: a bare secret unless something is non-default
+    entry = normalize_entry(entry)
+    defaults = {'issuer': None, 'digits': DEFAULT_DIGITS, 'period': DEFAULT_INTERVAL, 'algorithm': DEFAULT_ALGORITHM}
+    params = {k:v for k, v in entry.items() if k in defaults and v != defaults[k]}
+    return {'secret': entry['secret'], **params} if params else entry['secret']
+
+def decode_entry(entry: Entry, digits: int = DEFAULT_DIGITS, interval: int = DEFAULT_INTERVAL) -> Tuple[bytes, int, int, str]:
+    # (key, digits, period, hmac digest name); digits/interval apply to bare secrets
+    if isinstance(entry, str):
+        return (decode_secret(entry), digits, interval, 'sha1')
+    entry = normalize_entry(entry)
+    return (decode_secret(entry['secret']), entry['digits'], entry['period'], entry['algorithm'].lower())
+
+def entry_secret(entry: Entry) -> str:
+    return entry if isinstance(entry, str) else entry['secret']
+
+def hotp(key: bytes, counter: int, digits: int = DEFAULT_DIGITS, algorithm: str = DEFAULT_ALGORITHM) -> str:
+    return truncate(hmac.digest(key, pack('>Q', counter), algorithm.lower()), digits)
+
+def truncate(digest: bytes, digits: int = DEFAULT_DIGITS) -> str:
+    offset = digest[-1] & 0x0f
+    code = int.from_bytes(digest[offset:offset + 4], 'big') & 0x7fffffff
+    return str(code % 10 ** digits).zfill(digits)
+
+# Decoded secrets for a whole vault, one slot per entry: the key bytes live back
+# to back in a single bytearray and the per-entry params in typed arrays, so an
+# entry costs its key length plus a few bytes instead of a tuple, a bytes object
+# and the base32 string. Reading it as a Mapping gives back keyfile entries,
+# rebuilt from the key bytes.
+#
+# Not locked: CodeEngine serializes access to the store it owns. Memoryviews
+# from slots() must be dropped before the next add(), the buffer can't grow while
+# one is alive.
+class SecretStore(Mapping):
+    __slots__ = ('digits', 'interval', 'invalid', '_index', '_names', '_buffer', '_offsets', '_lengths', '_digits', '_periods', '_algorithms', '_issuers', '_garbage')
+
+    # removed slots are only reclaimed once they outnumber the live ones
+    COMPACT_MIN = 32
+
+    def __init__(self, entries: Optional[Mapping] = None, digits: int = DEFAULT_DIGITS, interval: int = DEFAULT_INTERVAL):
+        # digits/interval apply to entries that are a bare secret
+        self.digits = digits
+        self.interval = interval
+        # entries that can't be decoded, as they were given: they have no code
+        # and aren't part of the mapping, but to_dict() still writes them back
+        self.invalid: Dict[str, Entry] = {}
+        self._reset()
+        if entries:
+            self.load(entries)
+
+    def _reset(self) -> None:
+        self._index: Dict[str, int] = {}
+        self._names = []
+        self._buffer = bytearray()
+        self._offsets = array('L')
+        self._lengths = array('H')
+        self._digits = array('B')
+        self._periods = array('L')
+        self._algorithms = array('B')
+        # slot -> issuer, most entries don't have one
+        self._issuers: Dict[int, str] = {}
+        self._garbage = 0
+
+    def load(self, entries: Mapping) -> List[str]:
+        # one bad secret doesn't stop the vault from opening; returns the names
+        # of the entries that were set aside
+        self.zeroize()
+        for name, entry in entries.items():
+            self.keep(name, entry)
+        return list(self.invalid)
+
+    def keep(self, name: str, entry: Entry) -> bool:
+        # add(), or set the entry aside in invalid if it doesn't decode
+        try:
+            self.add(name, entry)
+        except (ValueError, TypeError):
+            self.remove(name)
+            self.invalid[name] = entry
+            return False
+        return True
+
+    def __getitem__(self, name: str) -> Entry:
+        slot = self._index[name]
+        start = self._offsets[slot]
+        secret = b32encode(self._buffer[start:start + self._lengths[slot]]).decode().rstrip('=')
+        algorithm = ALGORITHMS[self._algorithms[slot]]
+        params = {'issuer': self._issuers.get(slot), 'digits': self._digits[slot], 'period': self._periods[slot], 'algorithm': algorithm}
+        defaults = {'issuer': None, 'digits': self.digits, 'period': self.interval, 'algorithm': ALGORITHMS[0]}
+        params = {k:v for k, v in params.items() if v != defaults[k]}
+        return {'secret': secret, **params} if params else secret
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._index
+
+    def add(self, name: str, entry: Entry) -> None:
+        key, digits, period, algorithm = decode_entry(entry, self.digits, self.interval)
+        if name in self._index:
+            self.remove(name)
+        self.invalid.pop(name, None)
+        if isinstance(entry, dict) and entry.get('issuer'):
+            self._issuers[len(self._names)] = entry['issuer']
+        self._index[name] = len(self._names)
+        self._names.append(name)
+        self._offsets.append(len(self._buffer))
+        self._lengths.append(len(key))
+        self._buffer += key
+        self._digits.append(digits)
+        self._periods.append(period)
+        self._algorithms.append(ALGORITHMS.index(algorithm.upper()))
+
+    def remove(self, name: str) -> None:
+        self.invalid.pop(name, None)
+        slot = self._index.pop(name, None)
+        if slot is None:
+            return
+        start = self._offsets[slot]
+        self._buffer[start:start + self._lengths[slot]] = bytes(self._lengths[slot])
+        self._names[slot] = None
+        self._issuers.pop(slot, None)
+        self._garbage += 1
+        if self._garbage > self.COMPACT_MIN and self._garbage > len(self._index):
+            self._compact()
+
+    def _compact(self) -> None:
+        live = [(name, self._slot(slot)) for name, slot in self._index.items()]
+        issuers = [self._issuers.get(slot) for slot in self._index.values()]
+        invalid = self.invalid
+        self.zeroize()
+        self.invalid = invalid
+        for (name, (key, digits, period, algorithm)), issuer in zip(live, issuers):
+            if issuer:
+                self._issuers[len(self._names)] = issuer
+            self._index[name] = len(self._names)
+            self._names.append(name)
+            self._offsets.append(len(self._buffer))
+            self._lengths.append(len(key))
+            self._buffer += key
+            self._digits.append(digits)
+            self._periods.append(period)
+            self._algorithms.append(algorithm)
+        # the copies made for the move
+        for _, (key, *_) in live:
+            key[:] = bytes(len(key))
+
+    def _slot(self, slot: int) -> Tuple[bytearray, int, int, int]:
+        start = self._offsets[slot]
+        return (self._buffer[start:start + self._lengths[slot]], self._digits[slot], self._periods[slot], self._algorithms[slot])
+
+    def period(self, name: str) -> int:
+        return self._periods[self._index[name]]
+
+    def periods(self) -> Tuple[int, ...]:
+        return tuple(sorted({self._periods[slot] for slot in self._index.values()}))
+
+    def slots(self) -> Iterator[Tuple[str, memoryview, int, int, str]]:
+        # (name, key, digits, period, hmac digest name) for every live entry
+        view = memoryview(self._buffer)
+        names, offsets, lengths, digits, periods, algorithms = self._names, self._offsets, self._lengths, self._digits, self._periods, self._algorithms
+        digest_names = [a.lower() for a in ALGORITHMS]
+        for slot, name in enumerate(names):
+            if name is not None:
+                yield (name, view[offsets[slot]:offsets[slot] + lengths[slot]], digits[slot], periods[slot], digest_names[algorithms[slot]])
+
+    def to_dict(self) -> Dict[str, Entry]:
+        # what KeyFile.write_keys takes, entries that didn't decode included
+        return {**self.invalid, **{name:self[name] for name in self._index}}
+
+    def zeroize(self) -> None:
+        # overwritten in place before it's let go; copies already handed out
+        # (entries, codes) are the caller's to drop
+        self._buffer[:] = bytes(len(self._buffer))
+        self.invalid = {}
+        self._reset()
+
+class CodeEngine:
+    # number of time steps kept in the cache, enough for current/previous/next
+    CACHE_STEPS = 3
+
+    def __init__(self, secrets: Optional[Dict[str, Entry]] = None, interval: int = DEFAULT_INTERVAL, digits: int = DEFAULT_DIGITS, clock: Callable[[], float] = time):
+        # interval/digits are the defaults for entries that don't set their own
+        self.interval = interval
+        self.digits = digits
+        # "now" whenever for_time isn't given
+        self._clock = clock
+        # the engine's lock covers every access to the store, including callers
+        # reading entries back out of it
+        self.store = SecretStore(digits=digits, interval=interval)
+        self._periods: Tuple[int, ...] = ()
+        # keyed on the (period, step) of every period in the vault
+        self._cache = {}
+        self._lock = Lock()
+        if secrets:
+            self.set_secrets(secrets)
+
+    def _decode(self, entry: Entry) -> Tuple[bytes, int, int, str]:
+        return decode_entry(entry, self.digits, self.interval)
+
+    def set_secrets(self, secrets: Dict[str, Entry]) -> List[str]:
+        # returns the names of entries that couldn't be decoded, see SecretStore.load
+        with self._lock:
+            skipped = self.store.load(secrets)
+            self._periods = self.store.periods()
+            self._cache.clear()
+        return skipped
+
+    def merge(self, changes: List[Tuple[str, Optional[Entry]]]) -> List[str]:
+        # (name, entry) / (name, None) changes read back from a keyfile; like
+        # set_secrets, entries that don't decode are set aside and named
+        skipped = []
+        with self._lock:
+            for name, entry in changes:
+                if entry is None:
+                    self.store.remove(name)
+                elif not self.store.keep(name, entry):
+                    skipped.append(name)
+            self._periods = self.store.periods()
+            self._cache.clear()
+        return skipped
+
+    def add(self, name: str, entry: Entry) -> None:
+        key = self._decode(entry)
+        with self._lock:
+            self.store.add(name, entry)
+            self._update_periods()
+            # cached dicts are handed out to callers, so replace rather than mutate them
+            self._cache = {steps:{**codes, name:hotp(key[0], dict(steps)[key[2]], key[1], key[3])} for steps, codes in self._cache.items()}
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            self.store.remove(name)
+            self._update_periods()
+            self._cache = {steps:{n:c for n, c in codes.items() if n != name} for steps, codes in self._cache.items()}
+
+    def _update_periods(self) -> None:
+        periods = self.store.periods()
+        if periods != self._periods:
+            self._periods = periods
+            self._cache.clear()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.store
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def entry(self, name: str) -> Entry:
+        with self._lock:
+            return self.store[name]
+
+    def entries(self) -> Dict[str, Entry]:
+        with self._lock:
+            return self.store.to_dict()
+
+    def period(self, name: str) -> int:
+        with self._lock:
+            return self.store.period(name) if name in self.store else self.interval
+
+    def periods(self) -> Tuple[int, ...]:
+        return self._periods
+
+    def step(self, for_time: Optional[float] = None, period: Optional[int] = None) -> int:
+        return int((self._clock() if for_time is None else for_time) // (period or self.interval))
+
+    def remaining(self, for_time: Optional[float] = None, period: Optional[int] = None) -> float:
+        period = period or self.interval
+        return period - (self._clock() if for_time is None else for_time) % period
+
+    def codes(self, for_time: Optional[float] = None) -> Dict[str, str]:
+        now = self._clock() if for_time is None else for_time
+        with self._lock:
+            steps = tuple((period, int(now // period)) for period in self._periods)
+            codes = self._cache.get(steps)
+            if codes is None:
+                codes = self._compute(steps)
+        return codes
+
+    def cached(self, for_time: Optional[float] = None) -> Optional[Dict[str, str]]:
+        # codes() if some caller already computed them for this step, else None
+        now = self._clock() if for_time is None else for_time
+        with self._lock:
+            return self._cache.get(tuple((period, int(now // period)) for period in self._periods))
+
+    def code(self, name: str, for_time: Optional[float] = None) -> str:
+        return self.codes(for_time)[name]
+
+    def codes_for(self, names: Iterable[str], for_time: Optional[float] = None) -> Dict[str, str]:
+        codes = self.codes(for_time)
+        return {name:codes[name] for name in names if name in codes}
+
+    def zeroize(self) -> None:
+        # on lock/exit; the engine is empty afterwards
+        with self._lock:
+            self.store.zeroize()
+            self._periods = ()
+            self._cache.clear()
+
+    def _compute(self, steps: Tuple[Tuple[int, int], ...]) -> Dict[str, str]:
+        # one counter encoding per period and one HMAC per entry for the whole vault
+        counters = {period:pack('>Q', step) for period, step in steps}
+        digest = hmac.digest
+        codes = {name:truncate(digest(key, counters[period], alg), digits) for name, key, digits, period, alg in self.store.slots()}
+        self._cache[steps] = codes
+        while len(self._cache) > self.CACHE_STEPS:
+            del self._cache[min(self._cache)]
+        return codes
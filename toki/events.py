@@ -1,21 +1,34 @@
+import os
 from abc import ABC
 from contextlib import suppress
 from functools import wraps
-from threading import Thread
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import perf_counter
 from traceback import print_exc
-from typing import Any, Callable, Optional, Union
-from queue import Queue
+from typing import Any, Callable, Dict, Optional
+
+from toki.instrument import STATS, profiled, subscriber_name
+
+# TOKI_TRACE=<path> records every event published on the global EventSystem to
+# <path>, redacted, for bench.replay
+ENV_TRACE = 'TOKI_TRACE'
 
 class Event:
     PASSWORD = '<<PASSWORD>>'
+    UNLOCK_PROGRESS = '<<UNLOCK_PROGRESS>>'
+    KEYFILE_CHANGED = '<<KEYFILE_CHANGED>>'
+    KEYFILE_WRITE_FAILED = '<<KEYFILE_WRITE_FAILED>>'
     TOTP_LIST = '<<TOTP_LIST>>'
     TOTP_SELECTED = '<<TOTP_SELECTED>>'
     TOTP_UPDATE = '<<TOTP_UPDATE>>'
+    TOTP_CODES = '<<TOTP_CODES>>'
     TIMER_UPDATE = '<<TIMER_UPDATE>>'
     ADD_TOTP = '<<ADD_TOTP>>'
     SHOW_TOTP = '<<SHOW_TOTP>>'
     REMOVE_TOTP = '<<REMOVE_TOTP>>'
     COPY_TOTP = '<<COPY_TOTP>>'
+    CLIPBOARD_COPY = '<<CLIPBOARD_COPY>>'
     MENU_ADD_TOTP = '<<MENU_ADD_TOTP>>'
     MENU_SHOW_TOTP = '<<MENU_SHOW_TOTP>>'
     MENU_REMOVE_TOTP = '<<MENU_REMOVE_TOTP>>'
@@ -24,58 +37,182 @@ class Event:
     SHOW_TOTP_FRAME = '<<SHOW_TOTP_FRAME>>'
 
 
+class EventPolicy:
+    # plain FIFO, dropped when the queue is full
+    NORMAL = 'normal'
+    # only the latest pending value is delivered, at the position of the first one
+    COALESCE = 'coalesce'
+    # dispatched ahead of everything else and never dropped
+    PRIORITY = 'priority'
+
+
+DEFAULT_POLICIES = {
+    Event.TIMER_UPDATE: EventPolicy.COALESCE,
+    Event.TOTP_UPDATE: EventPolicy.COALESCE,
+    Event.TOTP_CODES: EventPolicy.COALESCE,
+    Event.CLIPBOARD_COPY: EventPolicy.COALESCE,
+    Event.PASSWORD: EventPolicy.PRIORITY,
+    Event.UNLOCK_PROGRESS: EventPolicy.PRIORITY,
+    Event.TOTP_LIST: EventPolicy.PRIORITY,
+    Event.SHOW_TOTP: EventPolicy.PRIORITY,
+    Event.SHOW_TOTP_FRAME: EventPolicy.PRIORITY,
+    Event.TOTP_SELECTED: EventPolicy.PRIORITY,
+    Event.ADD_TOTP: EventPolicy.PRIORITY,
+    Event.REMOVE_TOTP: EventPolicy.PRIORITY,
+    Event.COPY_TOTP: EventPolicy.PRIORITY,
+    Event.MENU_ADD_TOTP: EventPolicy.PRIORITY,
+    Event.MENU_SHOW_TOTP: EventPolicy.PRIORITY,
+    Event.MENU_REMOVE_TOTP: EventPolicy.PRIORITY,
+    Event.MENU_CHANGE_PASSWORD: EventPolicy.PRIORITY,
+    Event.MENU_EXIT: EventPolicy.PRIORITY,
+}
+DEFAULT_MAXSIZE = 256
+
+
 class EventSystem:
     class Event:
         def __init__(self, name: str, data: Optional[Any] = None):
             self.name = name
             self.data = data
+            self.queued_at = perf_counter() if STATS.enabled else None
 
-    def __init__(self):
+    # maxsize=0 and no policies is the original unbounded FIFO. With threaded=False
+    # nothing is dispatched until the owner calls drain(), in its own thread; the
+    # replay harness runs the application that way against a virtual clock
+    def __init__(self, maxsize: int = 0, policies: Optional[Dict[str, str]] = None, threaded: bool = True):
+        # copy-on-write: replaced wholesale on (un)subscribe, never mutated
         self.subscribers = {}
-        self._queue = Queue()
-        self._thread = Thread(None, self._consumer_thread, daemon=True)
+        self.maxsize = maxsize
+        self.policies = dict(policies or {})
+        self.threaded = threaded
+        # tap(name, data) sees every publish before it's queued, see toki.trace
+        self.tap = None
+        self._subscribers_lock = Lock()
+        self._cond = Condition()
+        self._priority = deque()
+        self._normal = deque()
+        self._coalesced = {}
+        # the consumer thread starts with the first publish, nothing has to be
+        # dispatched before then
+        self._thread = None
         self._running = True
-        self._thread.start()
 
     def _consumer_thread(self):
-        while self._running:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._priority or self._normal or not self._running)
+                if not self._running:
+                    return
+                event = self._next_event()
+            #print('consuming', event)
+            self._dispatch(event)
+
+    def drain(self) -> int:
+        # dispatches everything queued so far, including whatever the subscribers
+        # publish meanwhile; returns the number of events dispatched
+        count = 0
+        while True:
+            with self._cond:
+                if not (self._priority or self._normal):
+                    return count
+                event = self._next_event()
+            self._dispatch(event)
+            count += 1
+
+    def _dispatch(self, event: 'EventSystem.Event') -> None:
+        if STATS.enabled:
+            self._dispatch_instrumented(event)
+            return
+        for func in self.subscribers.get(event.name, ()):
             try:
-                event = self._queue.get()
-                #print('consuming', event)
-                for func in self.subscribers.get(event.name, []):
-                    func(event.data)
-            except Exception as ex:
+                func(event.data)
+            except Exception:
+                print("Exception in EventSystem consumer")
+                print_exc()
+
+    def _dispatch_instrumented(self, event: 'EventSystem.Event') -> None:
+        STATS.gauge('queue_depth', event.name, -1)
+        if event.queued_at is not None:
+            STATS.record('event_wait', event.name, perf_counter() - event.queued_at)
+        for func in self.subscribers.get(event.name, ()):
+            start = perf_counter()
+            try:
+                func(event.data)
+            except Exception:
+                STATS.record('subscriber_errors', subscriber_name(func), 0.0)
                 print("Exception in EventSystem consumer")
                 print_exc()
             finally:
-                self._queue.task_done()
+                STATS.record('subscriber', f"{event.name} {subscriber_name(func)}", perf_counter() - start)
 
+    def _next_event(self) -> 'EventSystem.Event':
+        if self._priority:
+            return self._priority.popleft()
+        event = self._normal.popleft()
+        if isinstance(event, str):
+            # placeholder for a coalesced event, pick up its latest value
+            return self._coalesced.pop(event)
+        return event
 
     def subscribe(self, name: str, consumer: Callable) -> None:
         #print(f'subscribing {name} to {consumer}')
-        if name not in self.subscribers:
-            self.subscribers[name] = []
-        self.subscribers[name].append(consumer)
+        with self._subscribers_lock:
+            subscribers = dict(self.subscribers)
+            subscribers[name] = subscribers.get(name, ()) + (consumer,)
+            self.subscribers = subscribers
 
     def unsubscribe(self, name: str, consumer: Callable) -> None:
-        if name not in self.subscribers:
-            return
+        with self._subscribers_lock:
+            funcs = list(self.subscribers.get(name, ()))
+            # == rather than is, bound methods are new objects on every access
+            if consumer not in funcs:
+                return
+            funcs.remove(consumer)
+            subscribers = dict(self.subscribers)
+            if funcs:
+                subscribers[name] = tuple(funcs)
+            else:
+                del subscribers[name]
+            self.subscribers = subscribers
 
-        for func in self.subscribers[name]:
-            if consumer is func:
-                del self.subscribers[name]
+    def full(self) -> bool:
+        return self.maxsize > 0 and len(self._normal) >= self.maxsize
 
-    def publish(self, name: str, data: Optional[Any] = None) -> bool:
-        if self._queue.full():
-            return False
+    def qsize(self) -> int:
+        return len(self._priority) + len(self._normal)
 
+    def publish(self, name: str, data: Optional[Any] = None) -> bool:
         #print('publish', name, data)
-        self._queue.put_nowait(self.Event(name, data))
+        policy = self.policies.get(name, EventPolicy.NORMAL)
+        if self.tap is not None:
+            self.tap(name, data)
+        with self._cond:
+            if self._thread is None and self._running and self.threaded:
+                self._thread = Thread(None, profiled(self._consumer_thread), name='EventSystem', daemon=True)
+                self._thread.start()
+            if policy == EventPolicy.PRIORITY:
+                self._priority.append(self.Event(name, data))
+            elif policy == EventPolicy.COALESCE and name in self._coalesced:
+                self._coalesced[name].data = data
+                return True
+            elif self.full():
+                if STATS.enabled:
+                    STATS.record('events_dropped', name, 0.0)
+                return False
+            elif policy == EventPolicy.COALESCE:
+                self._coalesced[name] = self.Event(name, data)
+                self._normal.append(name)
+            else:
+                self._normal.append(self.Event(name, data))
+            if STATS.enabled:
+                STATS.gauge('queue_depth', name, 1)
+            self._cond.notify()
         return True
 
     def stop(self) -> None:
-        self._running = False
-        self.publish('', None)
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
 
 
 class AbstractGlobalEvents(ABC):
@@ -104,10 +241,19 @@ class AbstractGlobalEvents(ABC):
 
 
 class GlobalEvents:
-    event_system = EventSystem()
+    # created by the first get_event_system(), not at import
+    event_system = None
+    _create_lock = Lock()
 
     @classmethod
-    def get_event_system(cls) -> Union[EventSystem, None]:
+    def get_event_system(cls) -> EventSystem:
+        if cls.event_system is None:
+            with cls._create_lock:
+                if cls.event_system is None:
+                    cls.event_system = EventSystem(DEFAULT_MAXSIZE, DEFAULT_POLICIES)
+                    if os.environ.get(ENV_TRACE):
+                        from toki.trace import TraceRecorder
+                        cls.event_system.tap = TraceRecorder(os.environ[ENV_TRACE])
         return cls.event_system
 
     @classmethod
@@ -132,12 +278,8 @@ class GlobalEvents:
 
     @classmethod
     def subscribe(cls, *args, **kwargs) -> None:
-        with suppress(AttributeError):
-            return cls.event_system.subscribe(*args, **kwargs)
+        return cls.get_event_system().subscribe(*args, **kwargs)
 
     @classmethod
     def publish(cls, *args, **kwargs) -> bool:
-        try:
-            return cls.event_system.publish(*args, **kwargs)
-        except AttributeError:
-            return False
+        return cls.get_event_system().publish(*args, **kwargs)
@@ -0,0 +1,154 @@
+import cProfile
+import json
+import os
+import sys
+from contextlib import contextmanager
+from functools import partial, wraps
+from threading import Lock, Thread, current_thread
+from time import perf_counter, sleep, time
+from typing import Callable, Dict, TextIO
+
+# TOKI_STATS=1 turns on recording, TOKI_STATS_INTERVAL=<seconds> also dumps a
+# snapshot to stderr that often, TOKI_PROFILE=<path> runs the EventSystem consumer
+# thread under cProfile and writes <path>.<thread name> when it exits.
+ENV_STATS = 'TOKI_STATS'
+ENV_STATS_INTERVAL = 'TOKI_STATS_INTERVAL'
+ENV_PROFILE = 'TOKI_PROFILE'
+
+class _Timing:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self) -> dict:
+        return {'count': self.count, 'total_s': self.total, 'mean_s': self.total / self.count if self.count else 0.0, 'max_s': self.max}
+
+class _Gauge:
+    __slots__ = ('value', 'max')
+
+    def __init__(self):
+        self.value = 0
+        self.max = 0
+
+    def add(self, delta: int) -> None:
+        self.value += delta
+        if self.value > self.max:
+            self.max = self.value
+
+    def as_dict(self) -> dict:
+        return {'current': self.value, 'max': self.max}
+
+class Stats:
+    # Everything is keyed (category, name), e.g. ('event_wait', '<<TOTP_UPDATE>>')
+    # or ('keyfile', 'kdf'). Callers check `enabled` first so the disabled cost
+    # is a single attribute read.
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = Lock()
+        self._timings: Dict[str, Dict[str, _Timing]] = {}
+        self._gauges: Dict[str, Dict[str, _Gauge]] = {}
+        self._dumper = None
+
+    def record(self, category: str, name: str, seconds: float) -> None:
+        with self._lock:
+            timings = self._timings.setdefault(category, {})
+            timing = timings.get(name)
+            if timing is None:
+                timing = timings[name] = _Timing()
+            timing.add(seconds)
+
+    def gauge(self, category: str, name: str, delta: int) -> None:
+        with self._lock:
+            gauges = self._gauges.setdefault(category, {})
+            gauge = gauges.get(name)
+            if gauge is None:
+                gauge = gauges[name] = _Gauge()
+            gauge.add(delta)
+
+    @contextmanager
+    def timer(self, category: str, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(category, name, perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            snapshot = {category:{name:t.as_dict() for name, t in timings.items()} for category, timings in self._timings.items()}
+            for category, gauges in self._gauges.items():
+                snapshot.setdefault(category, {}).update({name:g.as_dict() for name, g in gauges.items()})
+        snapshot['time'] = time()
+        return snapshot
+
+    def reset(self) -> None:
+        with self._lock:
+            self._timings.clear()
+            self._gauges.clear()
+
+    def dump(self, stream: TextIO = sys.stderr) -> None:
+        stream.write(json.dumps(self.snapshot()) + '\n')
+        stream.flush()
+
+    def start_dumping(self, interval: float, stream: TextIO = sys.stderr) -> None:
+        self.enabled = True
+        if self._dumper is not None:
+            return
+        def dumper():
+            while True:
+                sleep(interval)
+                self.dump(stream)
+        self._dumper = Thread(None, dumper, daemon=True)
+        self._dumper.start()
+
+def timed(category: str, name: str) -> Callable:
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not STATS.enabled:
+                return func(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                STATS.record(category, name, perf_counter() - start)
+        return wrapper
+    return decorator
+
+def profiled(func: Callable) -> Callable:
+    # wraps a thread target; a no-op unless TOKI_PROFILE is set
+    path = os.environ.get(ENV_PROFILE)
+    if not path:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            profile.dump_stats(f"{path}.{current_thread().name}")
+    return wrapper
+
+def subscriber_name(func: Callable) -> str:
+    if isinstance(func, partial):
+        # UIBridge subscribes partial(_enqueue, consumer, ...), name the consumer
+        inner = func.args[0] if func.args and callable(func.args[0]) else func.func
+        return subscriber_name(inner)
+    return getattr(func, '__qualname__', repr(func))
+
+STATS = Stats(enabled=os.environ.get(ENV_STATS, '') not in ('', '0'))
+if os.environ.get(ENV_STATS_INTERVAL):
+    STATS.start_dumping(float(os.environ[ENV_STATS_INTERVAL]))
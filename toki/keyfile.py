@@ -1,72 +1,604 @@
 import json
 import os
+import shutil
+import sys
 #import signal
-from argparse import ArgumentParser
-from base64 import b64encode, b64decode, urlsafe_b64encode
-from math import floor
-from pyotp import TOTP
-from cryptography.exceptions import InvalidTag
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import ciphers
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from base64 import b64encode, b64decode
+from contextlib import contextmanager
+from struct import Struct
+from threading import RLock, Thread
+from time import perf_counter
+from traceback import print_exc
+from typing import List, Optional, Tuple
+
+# cryptography is imported where it's first used, at unlock, so the password
+# prompt doesn't wait on it
+from toki.instrument import STATS, timed
+
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+FORMATS = (FORMAT_JSON, FORMAT_BINARY)
+
+# binary container: magic, version, kdf id, up to three kdf parameters, salt, iv,
+# tag, then raw ciphertext. version 1 only had room for pbkdf2 iterations
+BINARY_MAGIC = b'TOKI'
+BINARY_VERSION = 2
+BINARY_PREFIX = Struct('>4sB')
+BINARY_HEADERS = {
+    1: Struct('>BI16s16s16s'),
+    2: Struct('>BIII16s16s16s'),
+}
+READ_CHUNK_SIZE = 64 * 1024
+
+# kdf parameters are kept as a dict, e.g. {'name': 'scrypt', 'n': 32768, 'r': 8, 'p': 1},
+# stored as-is in json keyfiles and as (id, a, b, c) in binary ones
+KDF_PBKDF2_SHA256 = 'pbkdf2-sha256'
+KDF_SCRYPT = 'scrypt'
+KDFS = (KDF_PBKDF2_SHA256, KDF_SCRYPT)
+KDF_IDS = {KDF_PBKDF2_SHA256: 1, KDF_SCRYPT: 2}
+KDF_ITERATIONS = 100000
+SCRYPT_N = 2 ** 15
+SCRYPT_R = 8
+SCRYPT_P = 1
+# 128MiB of scrypt memory at r=8
+SCRYPT_MAX_N = 2 ** 17
+DEFAULT_KDFS = {
+    KDF_PBKDF2_SHA256: {'name': KDF_PBKDF2_SHA256, 'iterations': KDF_ITERATIONS},
+    KDF_SCRYPT: {'name': KDF_SCRYPT, 'n': SCRYPT_N, 'r': SCRYPT_R, 'p': SCRYPT_P},
+}
+# what a file without kdf fields was written with
+LEGACY_KDF = DEFAULT_KDFS[KDF_PBKDF2_SHA256]
+DEFAULT_UNLOCK_TIME = 0.5
 
 class CanNotDecrypt(Exception):
     pass
 
 class KeyFile:
-    def __init__(self, filepath, passphrase, create_file=False):
-        self._filepath = os.path.expanduser(filepath)
+    # format=None keeps whatever format an existing file is in, and json for new files.
+    # kdf=None keeps whatever kdf an existing file uses as long as it isn't below the
+    # current defaults, and uses LEGACY_KDF for new files; an explicit kdf is what new
+    # files get and what any file using different parameters is re-wrapped to on unlock
+    def __init__(self, filepath, passphrase, create_file=False, format=None, kdf=None):
+        if format is not None and format not in FORMATS:
+            raise ValueError(f"unknown keyfile format {format}")
+        if kdf is not None:
+            kdf = check_kdf(kdf)
+        # resolved, so the journal and lock file sit next to the real file however it's reached
+        self._filepath = os.path.realpath(os.path.expanduser(filepath))
+        self._lock_path = self._filepath + '.lock'
+        self._lock = RLock()
+        self._lock_file = None
+        self._lock_depth = 0
+        self._lock_exclusive = False
+        # file signature as of our last read or write, see changed()
+        self._known = None
+        self._stale = False
         self._passphrase = passphrase
+        self.format = format or FORMAT_JSON
+        self._keep_format = format is None
+        self.kdf = dict(kdf or LEGACY_KDF)
+        self._kdf_target = kdf
         self._salt   = None
         self._iv     = None
         self._tag    = None
+        # derived once per unlock and reused for every read/write of this session
+        self._key    = None
 
         if create_file:
-            print(f"initializing {self._filepath}")
+            print(f"initializing {self._filepath}", file=sys.stderr)
             self._salt = os.urandom(16)
             self._iv = os.urandom(16)
             self.write_keys({})
 
 
+    @timed('keyfile', 'read')
     def read_keys(self) -> dict:
-        with open(self._filepath, 'r') as f:
+        with self._locked(exclusive=False):
+            keys = self._read_snapshot()
+            self._upgrade_kdf(keys)
+            self._mark_read()
+            return keys
+
+    def signature(self) -> tuple:
+        return (stat_signature(self._filepath),)
+
+    def changed(self) -> bool:
+        # True once another process has written the file since we last read it.
+        # a stat() per file, cheap enough to poll
+        with self._lock:
+            return self._stale or self.signature() != self._known
+
+    def _mark_read(self) -> None:
+        self._known = self.signature()
+        self._stale = False
+
+    @contextmanager
+    def _locked(self, exclusive: bool = True):
+        # the thread lock plus an advisory lock on <keyfile>.lock, which unlike the
+        # keyfile itself is never replaced, so other processes wait for us. reads
+        # share it; a write inside a read (a kdf upgrade) upgrades it in place
+        with self._lock:
+            if self._lock_depth == 0:
+                self._lock_file = lock_file(self._lock_path, exclusive)
+                self._lock_exclusive = exclusive
+            elif exclusive and not self._lock_exclusive:
+                relock_file(self._lock_file, exclusive)
+                self._lock_exclusive = True
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    if self._lock_file is not None:
+                        self._lock_file.close()
+                    self._lock_file = None
+
+    @contextmanager
+    def _writing(self):
+        # someone else's write since our last read is remembered, so changed()
+        # still reports it after our own write updates the signature
+        with self._locked():
+            self._stale = self._stale or (self._known is not None and self.signature() != self._known)
+            try:
+                yield
+            finally:
+                self._known = self.signature()
+
+    def _read_snapshot(self) -> dict:
+        with open(self._filepath, 'rb') as f:
+            kdf, salt, self._iv, self._tag, encdata = self._read_header(f)
+            self._set_kdf(kdf, salt)
+            if encdata is None:
+                return self._read_binary(f)
+        return json.loads(self._decrypt(self._iv, encdata, self._tag))
+
+    def _read_header(self, f) -> Tuple[dict, bytes, bytes, bytes, Optional[bytes]]:
+        # kdf, salt, iv and tag of the snapshot, without decrypting anything. json
+        # files also give back their ciphertext; binary ones leave f positioned at it
+        detected = FORMAT_BINARY if f.read(len(BINARY_MAGIC)) == BINARY_MAGIC else FORMAT_JSON
+        if self._keep_format:
+            self.format = detected
+        f.seek(0)
+        if detected == FORMAT_JSON:
             data = json.loads(f.read())
-        if not all(k in data for k in ['iv', 'salt', 'encrypted_data', 'tag']):
+            if not all(k in data for k in ['iv', 'salt', 'encrypted_data', 'tag']):
+                raise ValueError(f"{self._filepath} exists but is invalid")
+            return check_kdf(data.get('kdf', LEGACY_KDF)), b64decode(data['salt']), b64decode(data['iv']), b64decode(data['tag']), b64decode(data['encrypted_data'])
+        _, version = BINARY_PREFIX.unpack(f.read(BINARY_PREFIX.size))
+        if version not in BINARY_HEADERS:
+            raise ValueError(f"{self._filepath} has unsupported version {version}")
+        header = f.read(BINARY_HEADERS[version].size)
+        if len(header) != BINARY_HEADERS[version].size:
             raise ValueError(f"{self._filepath} exists but is invalid")
-        self._salt = b64decode(data['salt'])
-        self._iv   = b64decode(data['iv'])
-        self._tag  = b64decode(data['tag'])
-        dec = create_cipher(pass2key(self._passphrase, self._salt), self._iv, tag=self._tag).decryptor()
-        try:
-            return json.loads(dec.update(b64decode(data['encrypted_data'])) + dec.finalize())
-        except InvalidTag:
-            raise CanNotDecrypt
+        if version == 1:
+            kdf_id, iterations, salt, iv, tag = BINARY_HEADERS[version].unpack(header)
+            params = (iterations, 0, 0)
+        else:
+            kdf_id, *params, salt, iv, tag = BINARY_HEADERS[version].unpack(header)
+        return unpack_kdf(kdf_id, params), salt, iv, tag, None
 
+    def _read_binary(self, f) -> dict:
+        # decrypt chunk by chunk so only the plaintext is ever held in full
+        dec = create_cipher(self._derive_key(), self._iv, tag=self._tag).decryptor()
+        plaintext = bytearray()
+        with STATS.timer('keyfile', 'decrypt'):
+            while chunk := f.read(READ_CHUNK_SIZE):
+                plaintext += dec.update(chunk)
+            plaintext += finalize(dec)
+        return json.loads(plaintext)
 
+    @timed('keyfile', 'write')
     def write_keys(self, keys:dict):
-        with open(self._filepath, 'w+') as f:
-            enc = create_cipher(pass2key(self._passphrase, self._salt), self._iv).encryptor()
-            encdata = enc.update(json.dumps(keys).encode()) + enc.finalize()
-            self._tag = enc.tag
-            f.write(json.dumps({
-                'salt': b64encode(self._salt).decode(),
-                'iv': b64encode(self._iv).decode(),
+        # never truncate the only copy of the vault; write aside and swap it in
+        with self._writing():
+            replace_file(self._filepath, self._dump(keys))
+
+    def update_keys(self, keys: dict, changes: List[Tuple[str, Optional[str]]]) -> None:
+        # changes are (name, secret) for an add and (name, None) for a remove.
+        # this format only holds a single blob, so it has to rewrite everything
+        self.write_keys(keys)
+
+    def flush(self) -> None:
+        pass
+
+    def rewrap(self, keys: dict, kdf: dict) -> None:
+        # new salt and kdf parameters, so a new key; the passphrase stays the same
+        with self._writing():
+            self.kdf = check_kdf(kdf)
+            self._salt = os.urandom(16)
+            self._key = None
+            self.write_keys(keys)
+
+    def _upgrade_kdf(self, keys: dict) -> None:
+        # only called after a successful decrypt, so the passphrase is known good
+        target = self._kdf_target
+        if target is None and not kdf_outdated(self.kdf):
+            return
+        if target is not None and target == self.kdf:
+            return
+        target = target or DEFAULT_KDFS[self.kdf['name']]
+        print(f"re-wrapping {self._filepath} with {describe_kdf(target)}", file=sys.stderr)
+        self.rewrap(keys, target)
+
+    def _dump(self, keys: dict) -> bytes:
+        # the key is reused across writes, so GCM needs a fresh IV every time
+        iv, encdata, tag = self._encrypt(json.dumps(keys).encode())
+        self._iv, self._tag = iv, tag
+        if self.format == FORMAT_BINARY:
+            prefix = BINARY_PREFIX.pack(BINARY_MAGIC, BINARY_VERSION)
+            return prefix + BINARY_HEADERS[BINARY_VERSION].pack(*pack_kdf(self.kdf), self._salt, iv, tag) + encdata
+        return json.dumps({
+            'kdf': self.kdf,
+            'salt': b64encode(self._salt).decode(),
+            'iv': b64encode(iv).decode(),
+            'encrypted_data': b64encode(encdata).decode(),
+            'tag': b64encode(tag).decode(),
+        }, separators=(',', ':')).encode()
+
+    def _set_kdf(self, kdf: dict, salt: bytes) -> None:
+        if salt != self._salt or kdf != self.kdf:
+            self._key = None
+        self.kdf = kdf
+        self._salt = salt
+
+    @timed('keyfile', 'encrypt')
+    def _encrypt(self, data: bytes) -> Tuple[bytes, bytes, bytes]:
+        iv = os.urandom(16)
+        enc = create_cipher(self._derive_key(), iv).encryptor()
+        encdata = enc.update(data) + enc.finalize()
+        return iv, encdata, enc.tag
+
+    @timed('keyfile', 'decrypt')
+    def _decrypt(self, iv: bytes, data: bytes, tag: bytes) -> bytes:
+        dec = create_cipher(self._derive_key(), iv, tag=tag).decryptor()
+        return dec.update(data) + finalize(dec)
+
+    def lock(self) -> None:
+        self._key = None
+        self._passphrase = None
+
+    def _derive_key(self) -> bytes:
+        if self._key is None:
+            if self._passphrase is None:
+                raise CanNotDecrypt("keyfile is locked")
+            with STATS.timer('keyfile', 'kdf'):
+                self._key = derive_key(self._passphrase, self._salt, self.kdf)
+        return self._key
+
+# The regular keyfile is kept as a snapshot and every edit is appended to
+# <keyfile>.journal as its own encrypted record, so an add/remove costs the same
+# no matter how large the vault is. Once the journal grows past COMPACT_THRESHOLD
+# records it is folded back into the snapshot on a background thread. Compaction
+# works from what's on disk rather than from memory, so records appended by
+# another process are never dropped.
+# Each record names the snapshot it applies to (by the snapshot's IV, fresh on
+# every write), so records left behind by a crash between replacing the snapshot
+# and removing the journal are ignored rather than replayed onto the new one.
+# A plain keyfile is a valid snapshot with an empty journal, so existing files are
+# read as-is and migrate on the first edit; compact() leaves a plain keyfile again.
+class JournaledKeyFile(KeyFile):
+    COMPACT_THRESHOLD = 64
+
+    def __init__(self, filepath, passphrase, create_file=False, format=None, kdf=None):
+        self._journal_path = os.path.realpath(os.path.expanduser(filepath)) + '.journal'
+        self._journal_records = 0
+        self._compactor = None
+        super().__init__(filepath, passphrase, create_file, format, kdf)
+
+    @timed('keyfile', 'replay')
+    def read_keys(self) -> dict:
+        with self._locked(exclusive=False):
+            keys = self._read_all()
+            # the journal is encrypted under the old key, so upgrading folds it in
+            self._upgrade_kdf(keys)
+            self._mark_read()
+            return keys
+
+    def _read_all(self) -> dict:
+        keys = self._read_snapshot()
+        self._journal_records = 0
+        for changes in self._read_journal():
+            apply_changes(keys, changes)
+            self._journal_records += 1
+        return keys
+
+    def signature(self) -> tuple:
+        return (stat_signature(self._filepath), stat_signature(self._journal_path))
+
+    @timed('keyfile', 'write')
+    def write_keys(self, keys: dict):
+        with self._writing():
+            replace_file(self._filepath, self._dump(keys))
+            self._truncate_journal()
+
+    @timed('keyfile', 'append')
+    def update_keys(self, keys: dict, changes: List[Tuple[str, Optional[str]]]) -> None:
+        if not changes:
+            return
+        with self._writing():
+            self._sync_snapshot()
+            iv, encdata, tag = self._encrypt(json.dumps(changes).encode())
+            record = json.dumps({
+                'snapshot': snapshot_id(self._iv),
+                'iv': b64encode(iv).decode(),
                 'encrypted_data': b64encode(encdata).decode(),
-                'tag': b64encode(self._tag).decode(),
-            }, separators=(',', ':')))
+                'tag': b64encode(tag).decode(),
+            }, separators=(',', ':')) + '\n'
+            self._repair_journal()
+            with open(os.open(self._journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600), 'a') as f:
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_records += 1
+            if self._journal_records >= self.COMPACT_THRESHOLD and not self._compacting():
+                self._compactor = Thread(None, self._compact, daemon=True)
+                self._compactor.start()
+
+    def compact(self, keys: dict) -> None:
+        self.flush()
+        self.write_keys(keys)
+
+    def rewrap(self, keys: dict, kdf: dict) -> None:
+        self.flush()
+        super().rewrap(keys, kdf)
+
+    def flush(self) -> None:
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+
+    def _compacting(self) -> bool:
+        return self._compactor is not None and self._compactor.is_alive()
+
+    @timed('keyfile', 'compact')
+    def _compact(self) -> None:
+        # appends wait for this, it's one decrypt and encrypt of the vault
+        try:
+            with self._writing():
+                replace_file(self._filepath, self._dump(self._read_all()))
+                self._truncate_journal()
+        except Exception:
+            print("Exception compacting keyfile journal")
+            print_exc()
+
+    def _truncate_journal(self) -> None:
+        if os.path.isfile(self._journal_path):
+            os.remove(self._journal_path)
+        self._journal_records = 0
+
+    def _sync_snapshot(self) -> None:
+        # another process may have compacted since we read; records have to name
+        # the snapshot that's on disk now, and be encrypted under its key
+        with open(self._filepath, 'rb') as f:
+            kdf, salt, iv, tag, _ = self._read_header(f)
+        if kdf != self.kdf or salt != self._salt:
+            # re-wrapped or re-keyed elsewhere, so the key we hold is stale.
+            # re-reading derives the new one from our passphrase, or raises
+            # CanNotDecrypt if that passphrase no longer opens the vault
+            self._read_snapshot()
+        else:
+            self._iv, self._tag = iv, tag
+
+    def _repair_journal(self) -> None:
+        # an interrupted append leaves a record without its newline; cut it off so
+        # the next record starts on a line of its own
+        try:
+            f = open(self._journal_path, 'rb+')
+        except FileNotFoundError:
+            return
+        with f:
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(0, end - READ_CHUNK_SIZE)
+                f.seek(start)
+                chunk = f.read(end - start)
+                if end == size and chunk.endswith(b'\n'):
+                    return
+                newline = chunk.rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read_journal(self):
+        if not os.path.isfile(self._journal_path):
+            return
+        current = snapshot_id(self._iv)
+        with open(self._journal_path, 'r') as f:
+            for line in f:
+                record = parse_record(line)
+                if record is None:
+                    # a torn record from an interrupted append
+                    continue
+                # records from before 'snapshot' existed belong to whatever snapshot is there
+                if record.get('snapshot', current) != current:
+                    continue
+                yield json.loads(self._decrypt(b64decode(record['iv']), b64decode(record['encrypted_data']), b64decode(record['tag'])))
+
+def snapshot_id(iv: bytes) -> str:
+    return b64encode(iv).decode()
+
+def parse_record(line: str) -> Optional[dict]:
+    try:
+        return json.loads(line)
+    except ValueError:
+        pass
+    # older versions appended straight after a torn record, gluing the two
+    # together; records hold no nested objects, so the last '{' starts the
+    # complete one
+    start = line.rfind('{')
+    if start <= 0:
+        return None
+    try:
+        return json.loads(line[start:])
+    except ValueError:
+        return None
+
+def apply_changes(keys: dict, changes: List[Tuple[str, Optional[str]]]) -> dict:
+    for name, secret in changes:
+        if secret is None:
+            keys.pop(name, None)
+        else:
+            keys[name] = secret
+    return keys
+
+def diff_keys(old: dict, new: dict) -> List[Tuple[str, Optional[str]]]:
+    # the changes that turn old into new, in the form apply_changes takes
+    changes = [(name, None) for name in old if name not in new]
+    changes += [(name, entry) for name, entry in new.items() if name not in old or old[name] != entry]
+    return changes
+
+def convert_keyfile(filepath: str, passphrase: str, format: str) -> None:
+    # folds any journal into the snapshot and rewrites it in the requested format
+    keyfile = JournaledKeyFile(filepath, passphrase, format=format)
+    keyfile.write_keys(keyfile.read_keys())
+
+def stat_signature(filepath: str) -> Optional[Tuple[int, int, int]]:
+    # changes whenever the file is replaced (inode) or written to (size, mtime)
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def lock_file(filepath: str, exclusive: bool = True):
+    # returns the open lock file, closing it releases the lock. None when the
+    # lock file can't be created or opened (a read-only store), then there is
+    # nothing to lock against: nobody can be writing there either
+    try:
+        f = open(filepath, 'a')
+    except OSError:
+        try:
+            f = open(filepath, 'r')
+        except OSError:
+            return None
+    relock_file(f, exclusive)
+    return f
+
+def relock_file(f, exclusive: bool) -> None:
+    if f is None:
+        return
+    try:
+        import fcntl
+    except ImportError:
+        # no fcntl on Windows, there writes are only serialized within a process
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+def replace_file(filepath: str, data: bytes) -> None:
+    # a symlinked keyfile is written where it points, and the new file keeps the
+    # old one's mode; it is only ever readable by us while being written
+    filepath = os.path.realpath(filepath)
+    tmp = f"{filepath}.tmp"
+    with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, tmp)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filepath)
 
 def create_cipher(key, iv, tag=None):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import ciphers
     alg     = ciphers.algorithms.AES(key)
     mode    = ciphers.modes.GCM(iv, tag) if tag else ciphers.modes.GCM(iv)
     return ciphers.Cipher(alg, mode, backend=default_backend())
 
-def pass2key(passphrase, salt):
+def finalize(decryptor) -> bytes:
+    from cryptography.exceptions import InvalidTag
+    try:
+        return decryptor.finalize()
+    except InvalidTag:
+        raise CanNotDecrypt
+
+def derive_key(passphrase: str, salt: bytes, kdf: dict) -> bytes:
+    if kdf['name'] == KDF_SCRYPT:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+        return Scrypt(
+            salt = salt,
+            length = 32,
+            n = kdf['n'],
+            r = kdf['r'],
+            p = kdf['p'],
+            backend = default_backend(),
+        ).derive(passphrase.encode())
+    return pass2key(passphrase, salt, kdf['iterations'])
+
+def check_kdf(kdf: dict) -> dict:
+    name = kdf.get('name') if isinstance(kdf, dict) else None
+    if name not in KDFS:
+        raise ValueError(f"unsupported kdf {name}")
+    params = {k:int(kdf.get(k, v)) for k, v in DEFAULT_KDFS[name].items() if k != 'name'}
+    if name == KDF_SCRYPT and (params['n'] < 2 or params['n'] & (params['n'] - 1)):
+        raise ValueError(f"scrypt n must be a power of two, not {params['n']}")
+    if any(v <= 0 for v in params.values()):
+        raise ValueError(f"invalid {name} parameters {params}")
+    return {'name': name, **params}
+
+def kdf_outdated(kdf: dict) -> bool:
+    # weaker than what this version would create
+    if kdf['name'] == KDF_SCRYPT:
+        return kdf['n'] * kdf['r'] < SCRYPT_N * SCRYPT_R
+    return kdf['iterations'] < KDF_ITERATIONS
+
+def pack_kdf(kdf: dict) -> Tuple[int, int, int, int]:
+    if kdf['name'] == KDF_SCRYPT:
+        return (KDF_IDS[KDF_SCRYPT], kdf['n'], kdf['r'], kdf['p'])
+    return (KDF_IDS[KDF_PBKDF2_SHA256], kdf['iterations'], 0, 0)
+
+def unpack_kdf(kdf_id: int, params: Tuple[int, int, int]) -> dict:
+    if kdf_id == KDF_IDS[KDF_SCRYPT]:
+        return check_kdf({'name': KDF_SCRYPT, 'n': params[0], 'r': params[1], 'p': params[2]})
+    if kdf_id == KDF_IDS[KDF_PBKDF2_SHA256]:
+        return check_kdf({'name': KDF_PBKDF2_SHA256, 'iterations': params[0]})
+    raise ValueError(f"unsupported kdf id {kdf_id}")
+
+def describe_kdf(kdf: dict) -> str:
+    return ' '.join([kdf['name']] + [f"{k}={v}" for k, v in kdf.items() if k != 'name'])
+
+def calibrate_kdf(target: float = DEFAULT_UNLOCK_TIME, name: str = KDF_PBKDF2_SHA256) -> dict:
+    # times a cheap derivation on this host and scales it up to take about
+    # <target> seconds, never going below the defaults
+    salt = os.urandom(16)
+    if name == KDF_SCRYPT:
+        probe = {'name': KDF_SCRYPT, 'n': 2 ** 12, 'r': SCRYPT_R, 'p': SCRYPT_P}
+        per_n = _time_kdf(probe, salt) / probe['n']
+        n = SCRYPT_N
+        while n < SCRYPT_MAX_N and per_n * n * 2 <= target:
+            n *= 2
+        return {**probe, 'n': n}
+    if name == KDF_PBKDF2_SHA256:
+        probe = {'name': KDF_PBKDF2_SHA256, 'iterations': 10000}
+        per_iteration = _time_kdf(probe, salt) / probe['iterations']
+        iterations = int(target / per_iteration) // 1000 * 1000
+        return {**probe, 'iterations': max(iterations, KDF_ITERATIONS)}
+    raise ValueError(f"unsupported kdf {name}")
+
+def _time_kdf(kdf: dict, salt: bytes, repeat: int = 3) -> float:
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        derive_key('calibrate', salt, kdf)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def pass2key(passphrase, salt, iterations=KDF_ITERATIONS):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
     kdf = PBKDF2HMAC(
         algorithm = hashes.SHA256(),
         length = 32,
         salt = salt,
-        iterations = 100000,
+        iterations = iterations,
         backend = default_backend(),
     )
     return kdf.derive(passphrase.encode())
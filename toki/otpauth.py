@@ -0,0 +1,89 @@
+import csv
+import json
+from typing import Iterable, Iterator, TextIO, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+
+from toki.codes import Entry, compact_entry, normalize_entry
+
+FORMAT_URI = 'uri'
+FORMAT_CSV = 'csv'
+FORMAT_JSON = 'json'
+FORMATS = (FORMAT_URI, FORMAT_CSV, FORMAT_JSON)
+
+CSV_FIELDS = ('name', 'secret', 'issuer', 'digits', 'period', 'algorithm')
+
+class InvalidEntry(ValueError):
+    def __init__(self, line: int, message: str):
+        super().__init__(f"line {line}: {message}")
+        self.line = line
+
+def parse_uri(uri: str) -> Tuple[str, Entry]:
+    parts = urlsplit(uri.strip())
+    if parts.scheme != 'otpauth' or parts.netloc != 'totp':
+        raise ValueError("not an otpauth://totp/ URI")
+    name = unquote(parts.path.lstrip('/'))
+    if not name:
+        raise ValueError("URI has no label")
+    params = {k:v[0] for k, v in parse_qs(parts.query).items()}
+    issuer = params.get('issuer') or (name.split(':', 1)[0] if ':' in name else None)
+    return name, compact_entry({
+        'secret': params.get('secret', ''),
+        'issuer': issuer,
+        'digits': params.get('digits'),
+        'period': params.get('period'),
+        'algorithm': params.get('algorithm'),
+    })
+
+def to_uri(name: str, entry: Entry) -> str:
+    entry = normalize_entry(entry)
+    params = {k:v for k, v in entry.items() if v is not None}
+    return f"otpauth://totp/{quote(name, safe=':@')}?{urlencode(params)}"
+
+def read_entries(stream: TextIO, format: str = FORMAT_URI) -> Iterator[Tuple[str, Entry]]:
+    # yields validated (name, entry) pairs one line at a time
+    if format == FORMAT_CSV:
+        reader = csv.DictReader(stream)
+        rows = ((reader.line_num, row) for row in reader)
+    elif format in (FORMAT_URI, FORMAT_JSON):
+        rows = enumerate(stream, start=1)
+    else:
+        raise ValueError(f"unknown format {format}")
+
+    for line, row in rows:
+        try:
+            if format == FORMAT_CSV:
+                entry = dict(row)
+                name = entry.pop('name', None)
+            else:
+                row = row.strip()
+                if not row or row.startswith('#'):
+                    continue
+                if format == FORMAT_URI:
+                    yield parse_uri(row)
+                    continue
+                entry = json.loads(row)
+                name = entry.pop('name', None)
+            if not name:
+                raise ValueError("entry has no name")
+            yield name, compact_entry(entry)
+        except (ValueError, TypeError, AttributeError) as ex:
+            raise InvalidEntry(line, str(ex)) from ex
+
+def write_entries(stream: TextIO, entries: Iterable[Tuple[str, Entry]], format: str = FORMAT_URI) -> int:
+    count = 0
+    writer = None
+    if format == FORMAT_CSV:
+        writer = csv.DictWriter(stream, CSV_FIELDS)
+        writer.writeheader()
+    elif format not in (FORMAT_URI, FORMAT_JSON):
+        raise ValueError(f"unknown format {format}")
+
+    for name, entry in entries:
+        if format == FORMAT_URI:
+            stream.write(to_uri(name, entry) + '\n')
+        elif format == FORMAT_JSON:
+            stream.write(json.dumps({'name': name, **normalize_entry(entry)}) + '\n')
+        else:
+            writer.writerow({'name': name, **normalize_entry(entry)})
+        count += 1
+    return count
@@ -0,0 +1,136 @@
+from threading import Condition, Thread
+from time import sleep
+from traceback import print_exc
+from typing import Callable, List, Optional, Tuple, Union
+
+from toki.keyfile import KeyFile
+
+class KeyFileWriter:
+    # how long to wait after the first pending edit for more to arrive
+    COALESCE_DELAY = 0.05
+    # how long to wait before trying a failed write again
+    RETRY_DELAY = 5.0
+
+    # on_error(exception) is called from the writer thread when a write fails
+    # after the last one succeeded; the edits stay pending and are retried
+    def __init__(self, keyfile: KeyFile, on_error: Optional[Callable[[Exception], None]] = None):
+        self.keyfile = keyfile
+        self.on_error = on_error
+        # the last write's exception, None once a write succeeds
+        self.error = None
+        # finished writes, failed or not
+        self._attempts = 0
+        self._cond = Condition()
+        self._keys = None
+        self._changes = []
+        self._rewrite = False
+        self._busy = False
+        self._running = True
+        self._thread = Thread(None, self._writer_thread, daemon=True)
+        self._thread.start()
+
+    # keys can be a callable returning them, so they're only gathered when written
+    def update_keys(self, keys: Union[dict, Callable[[], dict]], changes: List[Tuple[str, Optional[str]]]) -> None:
+        with self._cond:
+            self._check_running()
+            self._keys = keys if callable(keys) else dict(keys)
+            self._changes.extend(changes)
+            self._cond.notify_all()
+
+    def write_keys(self, keys: Union[dict, Callable[[], dict]]) -> None:
+        with self._cond:
+            self._check_running()
+            self._keys = keys if callable(keys) else dict(keys)
+            self._changes = []
+            self._rewrite = True
+            self._cond.notify_all()
+
+    def _check_running(self) -> None:
+        # after stop() the thread is gone or going, an edit accepted now would be lost
+        if not self._running:
+            raise RuntimeError("KeyFileWriter is stopped")
+
+    def pending(self) -> bool:
+        with self._cond:
+            return self._keys is not None or self._busy
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        # False if the edits aren't written yet, including when the next attempt
+        # at writing them fails
+        with self._cond:
+            attempts = self._attempts
+            self._cond.wait_for(lambda: not self._busy and (self._keys is None or (self.error is not None and self._attempts > attempts)), timeout)
+            done = self._keys is None and not self._busy
+        if done:
+            self.keyfile.flush()
+        return done
+
+    def stop(self, timeout: Optional[float] = None) -> bool:
+        done = self.flush(timeout)
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        return done
+
+    def _writer_thread(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._keys is not None or not self._running)
+                if self._keys is None:
+                    return
+                self._busy = True
+            # let the rest of a burst (e.g. an import) land in the same write
+            sleep(self.COALESCE_DELAY)
+            with self._cond:
+                pending, changes, rewrite = self._keys, self._changes, self._rewrite
+                self._keys, self._changes, self._rewrite = None, [], False
+            error = None
+            try:
+                keys = pending() if callable(pending) else pending
+                if rewrite:
+                    self.keyfile.write_keys(keys)
+                else:
+                    self.keyfile.update_keys(keys, changes)
+            except Exception as ex:
+                # once per run of failures, not on every retry
+                if self.error is None:
+                    print("Exception in KeyFileWriter")
+                    print_exc()
+                error = ex
+            finally:
+                # don't hold on to the secrets until the next write
+                keys = None
+            with self._cond:
+                if error is not None:
+                    self._requeue(pending, changes, rewrite)
+                pending = changes = None
+                first_error = error is not None and self.error is None
+                self.error = error
+                self._attempts += 1
+                self._busy = False
+                self._cond.notify_all()
+            if error is None:
+                continue
+            if first_error and self.on_error:
+                try:
+                    self.on_error(error)
+                except Exception:
+                    print("Exception in KeyFileWriter error handler")
+                    print_exc()
+            with self._cond:
+                # stopping ends the retries, whatever is still pending is given up
+                if self._cond.wait_for(lambda: not self._running, self.RETRY_DELAY):
+                    return
+
+    def _requeue(self, keys: Union[dict, Callable[[], dict]], changes: List[Tuple[str, Optional[str]]], rewrite: bool) -> None:
+        # puts a failed write back ahead of whatever arrived in the meantime
+        if self._rewrite:
+            # a newer full write covers the failed one
+            return
+        if rewrite:
+            self._changes = []
+            self._rewrite = True
+        else:
+            self._changes = changes + self._changes
+        if self._keys is None:
+            self._keys = keys
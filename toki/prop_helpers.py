@@ -1,64 +1,72 @@
 from abc import ABC, abstractmethod
+from functools import lru_cache, partial
+from typing import Any, Tuple, Union
+
+# dotted keys are split once and the parts reused; UI code uses a small, fixed
+# set of paths so the cache never fills in practice
+PATH_CACHE_SIZE = 1024
+
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def split_path(key: str) -> Tuple[str, ...]:
+    # a leading or trailing '.' doesn't count, '.a' and 'a.' are plain keys
+    return tuple(key.split('.')) if '.' in key[1:-1] else (key,)
 
 class DottedDict(dict):
+    __slots__ = ('overwriteExisting', 'createOnAccess')
+
     def __init__(self, overwriteExisting = False, createOnAccess = False):
         self.overwriteExisting = overwriteExisting
         self.createOnAccess = createOnAccess
 
     def __setitem__(self, key, item, *args, **kwargs):
-        if '.' in key[1:-1]:
-            names = key.split('.')
-            d = self
-            for i, name in enumerate(names, start=1):
-                if i == len(names):
-                    d.__setitem__(name, item, *args, **kwargs)
-                else:
-                    if name not in d or (not isinstance(d[name], __class__) and self.overwriteExisting):
-                        d.__setitem__(name, DottedDict(self.overwriteExisting, self.createOnAccess))
-                    d = d[name]
-        else:
+        names = split_path(key)
+        if len(names) == 1:
             super().__setitem__(key, item, *args, **kwargs)
-
+            return item
+        d = self
+        for name in names[:-1]:
+            if name not in d or (not isinstance(d[name], __class__) and self.overwriteExisting):
+                d.__setitem__(name, DottedDict(self.overwriteExisting, self.createOnAccess))
+            d = d[name]
+        d.__setitem__(names[-1], item, *args, **kwargs)
         return item
 
     def __getitem__(self, key, *args, **kwargs):
-        if '.' in key[1:-1]:
-            names = key.split('.')
-            d = self
-            for i, name in enumerate(names, start=1):
-                d = d.__getitem__(name, *args, **kwargs)
-            return d
-        else:
-            return super().__getitem__(key, *args, **kwargs)
+        names = split_path(key)
+        if len(names) == 1:
+            return dict.__getitem__(self, key, *args, **kwargs)
+        d = self
+        for name in names:
+            # single names need no splitting, so our own nodes skip straight to
+            # dict's lookup (which still calls __missing__)
+            d = dict.__getitem__(d, name) if type(d) is DottedDict else d.__getitem__(name, *args, **kwargs)
+        return d
 
     def __missing__(self, key):
         if self.createOnAccess:
             self[key] = DottedDict(self.overwriteExisting, self.createOnAccess)
             return self[key]
         else:
-            return super().__missing__(key)
+            # dict has no __missing__ of its own to defer to
+            raise KeyError(key)
 
     def __delitem__(self, key, *args, **kwargs):
-        if '.' in key[1:-1]:
-            names = key.split('.')
-            d = self
-            for i, name in enumerate(names, start=1):
-                if i == len(names):
-                    del d[name]
-                else:
-                    d = d[name]
-        else:
+        names = split_path(key)
+        if len(names) == 1:
             return super().__delitem__(key, *args, **kwargs)
+        d = self
+        for name in names[:-1]:
+            d = d[name]
+        del d[names[-1]]
 
     def get(self, key, *args, **kwargs):
-        if '.' in key[1:-1]:
-            names = key.split('.')
-            d = self
-            for i, name in enumerate(names, start=1):
-                d = d.get(name, *args, **kwargs)
-            return d
-        else:
+        names = split_path(key)
+        if len(names) == 1:
             return super().__getitem__(key, *args, **kwargs)
+        d = self
+        for name in names:
+            d = d.get(name, *args, **kwargs)
+        return d
 
 class AbstractDottedProperties(ABC):
     def __init__(self, *args, **kwargs):
@@ -100,32 +108,52 @@ class NestedProperties:
         #print('delattr', name)
         super().__delattr__(name)
 
-# same API as NestedProperties but uses a DottedDict internally
+# same API as NestedProperties, with dict style iteration. Children live in the
+# instance __dict__ itself, so reading an existing path is plain attribute access
+# and __getattr__ only runs the first time a node is touched.
 class NestedPropertiesDict:
-    def __init__(self):
-        self._dict = {}
+    @property
+    def _dict(self):
+        return self.__dict__
 
     def __getattr__(self, name):
         #print('getattr', type(self), name)
-        if name not in self._dict:
-            self._dict[name] = NestedPropertiesDict()
-        return self._dict[name]
-
-    def __setattr__(self, name, value):
-        #print('__setattr__', name, value)
-        if name == '_dict':
-            super().__setattr__(name, value)
-        else:
-            self._dict[name] = value
+        if name.startswith('__'):
+            # copy/pickle probing for hooks
+            raise AttributeError(name)
+        prop = NestedPropertiesDict()
+        self.__dict__[name] = prop
+        return prop
 
     def __iter__(self):
-        return iter(self._dict)
+        return iter(self.__dict__)
 
     def items(self, *args, **kwargs):
-        return self._dict.items(*args, **kwargs)
+        return self.__dict__.items(*args, **kwargs)
 
     def values(self, *args, **kwargs):
-        return self._dict.values(*args, **kwargs)
+        return self.__dict__.values(*args, **kwargs)
+
+# Resolves a dotted path once and then reads or writes the last property with a
+# single dict operation, for paths used on every timer tick. Works on a
+# NestedPropertiesDict or a DottedDict. Replacing the leaf is seen through the
+# handle; replacing a node further up the path is not, make a new handle then.
+class PropertyHandle:
+    __slots__ = ('path', 'get', 'set')
+
+    def __init__(self, root: Union[NestedPropertiesDict, dict], path: str):
+        names = split_path(path)
+        node = root
+        for name in names[:-1]:
+            node = node[name] if isinstance(node, dict) else getattr(node, name)
+        container = node if isinstance(node, dict) else node.__dict__
+        self.path = path
+        # partials of the dict's own methods, so a read never enters Python code
+        self.get = partial(container.__getitem__, names[-1])
+        self.set = partial(container.__setitem__, names[-1])
+
+    def __call__(self) -> Any:
+        return self.get()
 
 if __name__ == '__main__':
     #d = DottedDict(overwriteExisting = True, createOnAccess = True)
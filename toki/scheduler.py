@@ -0,0 +1,144 @@
+from threading import Condition, Thread
+from time import monotonic, time
+from traceback import print_exc
+from typing import Callable, Dict, Hashable
+
+class _Job:
+    def __init__(self, callback: Callable, interval: float, aligned: bool):
+        self.callback = callback
+        self.interval = interval
+        # aligned jobs fire on wall-clock multiples of interval (TOTP steps),
+        # the others just every interval seconds from when they were started
+        self.aligned = aligned
+        self.paused = False
+        self.last_step = None
+        self.deadline = 0.0
+
+class Scheduler:
+    # upper bound on any single sleep so a wall clock jumping backwards is noticed
+    MAX_SLEEP = 5.0
+    # a mismatch between wall and monotonic elapsed time above this is a clock jump
+    JUMP_TOLERANCE = 0.5
+
+    # clock is the wall clock steps are aligned to and monotonic is only used to
+    # spot jumps in it; pass both from one toki.trace.VirtualClock to run the
+    # scheduler on virtual time, driving it with run_pending() instead of start()
+    def __init__(self, clock: Callable[[], float] = time, monotonic: Callable[[], float] = monotonic):
+        self._clock = clock
+        self._monotonic = monotonic
+        self._jobs: Dict[Hashable, _Job] = {}
+        self._cond = Condition()
+        self._running = False
+        self._thread = None
+        self._last_wall = None
+        self._last_mono = None
+
+    def at_step(self, key: Hashable, period: float, callback: Callable[[int], None]) -> None:
+        # callback(step) exactly once for every step of `period` seconds
+        with self._cond:
+            job = _Job(callback, period, aligned=True)
+            job.last_step = int(self._clock() // period)
+            job.deadline = (job.last_step + 1) * period
+            self._jobs[key] = job
+            self._cond.notify()
+
+    def every(self, key: Hashable, interval: float, callback: Callable[[float], None], paused: bool = False) -> None:
+        # callback(now) every `interval` seconds while not paused
+        with self._cond:
+            job = _Job(callback, interval, aligned=False)
+            job.paused = paused
+            job.deadline = self._clock()
+            self._jobs[key] = job
+            self._cond.notify()
+
+    def cancel(self, key: Hashable) -> None:
+        with self._cond:
+            self._jobs.pop(key, None)
+            self._cond.notify()
+
+    def pause(self, key: Hashable) -> None:
+        with self._cond:
+            if key in self._jobs:
+                self._jobs[key].paused = True
+
+    def resume(self, key: Hashable) -> None:
+        with self._cond:
+            job = self._jobs.get(key)
+            if job and job.paused:
+                job.paused = False
+                job.deadline = self._clock()
+                self._cond.notify()
+
+    def start(self) -> None:
+        self._running = True
+        self._thread = Thread(None, self._scheduler_thread, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def run_pending(self) -> float:
+        # one pass of the scheduler loop in the caller's thread: runs whatever is
+        # due now and returns the seconds until the next job is
+        with self._cond:
+            due = self._poll()
+        self._run(due)
+        with self._cond:
+            return self._next_timeout(self._clock())
+
+    def _scheduler_thread(self) -> None:
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                due = self._poll()
+            self._run(due)
+            with self._cond:
+                if not self._running:
+                    return
+                timeout = self._next_timeout(self._clock())
+                if timeout > 0:
+                    self._cond.wait(timeout)
+
+    def _poll(self) -> list:
+        now = self._clock()
+        mono = self._monotonic()
+        jumped = self._last_wall is not None and abs((now - self._last_wall) - (mono - self._last_mono)) > self.JUMP_TOLERANCE
+        self._last_wall, self._last_mono = now, mono
+        return self._collect_due(now, jumped)
+
+    def _run(self, due: list) -> None:
+        for job, arg in due:
+            try:
+                job.callback(arg)
+            except Exception:
+                print("Exception in scheduler")
+                print_exc()
+
+    def _collect_due(self, now: float, jumped: bool) -> list:
+        due = []
+        for job in list(self._jobs.values()):
+            if job.paused:
+                continue
+            if job.aligned:
+                step = int(now // job.interval)
+                # compare steps rather than deadlines so a jump in either direction
+                # still yields a single callback for the step we landed in
+                if step != job.last_step:
+                    job.last_step = step
+                    due.append((job, step))
+                job.deadline = (step + 1) * job.interval
+            elif now >= job.deadline or jumped:
+                due.append((job, now))
+                # skip ticks that were missed rather than firing them all at once
+                if jumped or now - job.deadline > job.interval:
+                    job.deadline = now + job.interval
+                else:
+                    job.deadline += job.interval
+        return due
+
+    def _next_timeout(self, now: float) -> float:
+        deadlines = [job.deadline for job in self._jobs.values() if not job.paused]
+        return min([self.MAX_SLEEP] + [deadline - now for deadline in deadlines])
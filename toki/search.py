@@ -0,0 +1,117 @@
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# match kinds, best first
+EXACT = 0
+PREFIX = 1
+WORD_PREFIX = 2
+SUBSTRING = 3
+SUBSEQUENCE = 4
+
+WORD_SEPARATORS = ' :@._-/'
+
+class NameIndex:
+    def __init__(self, names: Iterable[str] = ()):
+        self._folded: Dict[str, str] = {}
+        # sorted (folded, name) pairs for prefix lookups
+        self._sorted: List[Tuple[str, str]] = []
+        # last query and its matches; a longer query can only match a subset
+        self._last: Optional[Tuple[str, List[str]]] = None
+        for name in names:
+            self.add(name)
+
+    def __len__(self) -> int:
+        return len(self._folded)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._folded
+
+    def add(self, name: str) -> None:
+        if name in self._folded:
+            return
+        folded = name.casefold()
+        self._folded[name] = folded
+        insort(self._sorted, (folded, name))
+        self._last = None
+
+    def remove(self, name: str) -> None:
+        folded = self._folded.pop(name, None)
+        if folded is None:
+            return
+        i = bisect_left(self._sorted, (folded, name))
+        del self._sorted[i]
+        if self._last is not None:
+            self._last = (self._last[0], [n for n in self._last[1] if n != name])
+
+    def sync(self, names: Iterable[str]) -> None:
+        # only touches the names that differ
+        names = set(names)
+        for name in [n for n in self._folded if n not in names]:
+            self.remove(name)
+        for name in names:
+            self.add(name)
+
+    def prefix(self, pattern: str) -> List[str]:
+        pattern = pattern.casefold()
+        i = bisect_left(self._sorted, (pattern, ''))
+        found = []
+        for folded, name in self._sorted[i:]:
+            if not folded.startswith(pattern):
+                break
+            found.append(name)
+        return found
+
+    def search(self, pattern: str, limit: Optional[int] = None) -> List[str]:
+        pattern = pattern.casefold()
+        if not pattern:
+            return sorted(self._folded)[:limit]
+
+        if self._last is not None and pattern.startswith(self._last[0]):
+            candidates = self._last[1]
+        else:
+            candidates = self._folded.keys()
+
+        ranked = []
+        for name in candidates:
+            rank = match_rank(pattern, self._folded[name])
+            if rank is not None:
+                ranked.append((rank, name))
+        ranked.sort()
+        matches = [name for _, name in ranked]
+        self._last = (pattern, matches)
+        return matches[:limit]
+
+def match_rank(pattern: str, text: str) -> Optional[Tuple[int, int, int]]:
+    # (kind, span, length): lower is better; None if pattern doesn't match at all
+    if text == pattern:
+        return (EXACT, 0, len(text))
+    pos = text.find(pattern)
+    if pos == 0:
+        return (PREFIX, 0, len(text))
+    if pos > 0:
+        while pos > 0 and text[pos - 1] not in WORD_SEPARATORS:
+            pos = text.find(pattern, pos + 1)
+        return (WORD_PREFIX if pos > 0 else SUBSTRING, 0, len(text))
+    span = subsequence_span(pattern, text)
+    if span is None:
+        return None
+    return (SUBSEQUENCE, span, len(text))
+
+def subsequence_span(pattern: str, text: str) -> Optional[int]:
+    # length of the shortest stretch of text holding pattern as a subsequence
+    best = None
+    start = text.find(pattern[0])
+    while start >= 0:
+        pos = start
+        for ch in pattern[1:]:
+            pos = text.find(ch, pos + 1)
+            if pos < 0:
+                return best
+        end = pos
+        # walk back from the end for the latest start that still fits
+        for ch in reversed(pattern[:-1]):
+            pos = text.rfind(ch, 0, pos)
+        if best is None or end - pos + 1 < best:
+            best = end - pos + 1
+        start = text.find(pattern[0], pos + 1)
+    return best
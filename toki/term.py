@@ -0,0 +1,54 @@
+import shutil
+import sys
+from typing import List, TextIO
+
+CSI = '\x1b['
+
+class TerminalRenderer:
+    # Keeps the last frame and only rewrites the part of each line that changed,
+    # using ANSI cursor addressing instead of clearing the screen.
+    def __init__(self, out: TextIO = sys.stdout):
+        self._out = out
+        self._lines: List[str] = []
+        self._size = None
+        self._started = False
+
+    def render(self, lines: List[str]) -> None:
+        buf = []
+        size = shutil.get_terminal_size()
+        if not self._started or size != self._size:
+            # clear once and hide the cursor for the lifetime of the renderer;
+            # after a resize the old frame may have wrapped, so start over
+            buf.append(f'{CSI}2J{CSI}H{CSI}?25l')
+            self._lines = []
+            self._size = size
+            self._started = True
+        # rows past the bottom or wrapping past the right edge would scroll or
+        # shift the screen under the absolute addressing; keep a row for close()
+        lines = [line[:size.columns - 1] for line in lines[:max(size.lines - 1, 1)]]
+        for row, line in enumerate(lines, start=1):
+            old = self._lines[row - 1] if row <= len(self._lines) else ''
+            if line == old:
+                continue
+            start = changed_from(old, line)
+            buf.append(f'{CSI}{row};{start + 1}H{line[start:]}')
+            if len(line) < len(old):
+                buf.append(f'{CSI}K')
+        for row in range(len(lines) + 1, len(self._lines) + 1):
+            buf.append(f'{CSI}{row};1H{CSI}2K')
+        self._lines = list(lines)
+        if buf:
+            self._out.write(''.join(buf))
+            self._out.flush()
+
+    def close(self) -> None:
+        if self._started:
+            self._out.write(f'{CSI}{len(self._lines) + 1};1H{CSI}?25h')
+            self._out.flush()
+            self._started = False
+
+def changed_from(old: str, new: str) -> int:
+    for i, (a, b) in enumerate(zip(old, new)):
+        if a != b:
+            return i
+    return min(len(old), len(new))
@@ -0,0 +1,110 @@
+import atexit
+import hmac
+import json
+import os
+from threading import Lock
+from time import time
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+from toki.events import Event
+
+TRACE_VERSION = 1
+
+# events that come from the user through the UI; a replay publishes these and
+# lets the application produce everything else again
+INPUT_EVENTS = frozenset([
+    Event.PASSWORD,
+    Event.TOTP_SELECTED,
+    Event.ADD_TOTP,
+    Event.REMOVE_TOTP,
+    Event.COPY_TOTP,
+    Event.SHOW_TOTP_FRAME,
+    Event.MENU_ADD_TOTP,
+    Event.MENU_SHOW_TOTP,
+    Event.MENU_REMOVE_TOTP,
+    Event.MENU_CHANGE_PASSWORD,
+    Event.MENU_EXIT,
+])
+
+# Written as EventSystem.tap. The first line is a header holding the wall clock
+# time recording started, so a replay lands on the same TOTP step boundaries;
+# then one [seconds since start, event, payload] line per publish.
+# Payloads are never written as they are: every string becomes "$<n>", numbered
+# by first appearance, so the trace keeps which names (or codes) are the same
+# without holding any names, codes, secrets or passwords. Numbers, booleans and
+# None are kept, anything else is reduced to its type.
+class TraceRecorder:
+    def __init__(self, path: str, clock: Callable[[], float] = time):
+        self._clock = clock
+        self._lock = Lock()
+        # strings are remembered by a keyed hash, never by value, so recording
+        # doesn't keep the password or codes alive in memory either
+        self._hash_key = os.urandom(16)
+        self._strings = {}
+        self._file = open(path, 'w')
+        self.start = clock()
+        self._write({'version': TRACE_VERSION, 'start': self.start})
+        atexit.register(self.close)
+
+    def __call__(self, name: str, data: Any = None) -> None:
+        with self._lock:
+            if self._file is None:
+                return
+            self._write([round(self._clock() - self.start, 6), name, self.redact(data)])
+
+    def redact(self, data: Any) -> Any:
+        if isinstance(data, str):
+            digest = hmac.digest(self._hash_key, data.encode(), 'sha256')
+            return f"${self._strings.setdefault(digest, len(self._strings))}"
+        if data is None or isinstance(data, (bool, int, float)):
+            return data
+        if isinstance(data, dict):
+            return {self.redact(k):self.redact(v) for k, v in data.items()}
+        if isinstance(data, (list, tuple)):
+            return [self.redact(v) for v in data]
+        return {'type': type(data).__name__}
+
+    def _write(self, record: Any) -> None:
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def read_trace(path: str) -> Tuple[dict, Iterator[Tuple[float, str, Any]]]:
+    f = open(path)
+    header = json.loads(f.readline())
+    if header.get('version') != TRACE_VERSION:
+        f.close()
+        raise ValueError(f"unsupported trace version {header.get('version')}")
+    def records():
+        with f:
+            for line in f:
+                if line.strip():
+                    offset, name, data = json.loads(line)
+                    yield offset, name, data
+    return header, records()
+
+# Wall clock and monotonic time that only move when advanced. Pass time and
+# monotonic to Scheduler (or the clock itself to Application) in place of the
+# real ones.
+class VirtualClock:
+    def __init__(self, start: Optional[float] = None):
+        self._now = time() if start is None else start
+        self._elapsed = 0.0
+
+    def time(self) -> float:
+        return self._now
+
+    def monotonic(self) -> float:
+        return self._elapsed
+
+    def advance(self, seconds: float) -> None:
+        if seconds > 0:
+            self._now += seconds
+            self._elapsed += seconds
+
+    def advance_to(self, now: float) -> None:
+        self.advance(now - self._now)
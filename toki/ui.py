@@ -1,19 +1,101 @@
+from bisect import bisect_left
 from functools import partial
+from threading import Lock
+from time import perf_counter
 import tkinter as tk
 from tkinter import ttk, messagebox, StringVar
-from typing import List, Tuple
-
-from pyotp import TOTP
-
-from toki.events import Event, GlobalEvents
-from toki.prop_helpers import NestedPropertiesDict
+from traceback import print_exc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from toki.clip import TkClipboard
+from toki.events import Event, EventSystem, GlobalEvents
+from toki.instrument import STATS, subscriber_name
+from toki.prop_helpers import NestedPropertiesDict, PropertyHandle
+from toki.search import NameIndex
 from toki.util import first
 
+class UIBridge:
+    # Stands in for the EventSystem inside the UI. Subscribers registered through
+    # it are queued from the consumer thread and run on the Tk thread, all of
+    # them from one after() callback per frame. Events with a collapse key only
+    # deliver the last value per key within a frame.
+    FRAME_MS = 20
+    COLLAPSE_KEYS = {
+        Event.TIMER_UPDATE: lambda data: None,
+        Event.TOTP_UPDATE: lambda data: data[0],
+        Event.TOTP_CODES: lambda data: None,
+        Event.CLIPBOARD_COPY: lambda data: None,
+    }
+
+    def __init__(self, root: tk.Tk, events: EventSystem):
+        self._root = root
+        self._events = events
+        self._lock = Lock()
+        self._pending = []
+        self._collapsed = {}
+        self._root.after(self.FRAME_MS, self._drain)
+
+    def subscribe(self, name: str, consumer: Callable, collapse_key: Optional[Callable[[Any], Any]] = None) -> None:
+        collapse_key = collapse_key or self.COLLAPSE_KEYS.get(name)
+        self._events.subscribe(name, partial(self._enqueue, consumer, name, collapse_key))
+
+    def publish(self, *args, **kwargs) -> bool:
+        return self._events.publish(*args, **kwargs)
+
+    def _enqueue(self, consumer: Callable, name: str, collapse_key: Optional[Callable], data: Any) -> None:
+        with self._lock:
+            if collapse_key is not None:
+                key = (name, consumer, collapse_key(data))
+                if key in self._collapsed:
+                    self._pending[self._collapsed[key]] = (consumer, data)
+                    return
+                self._collapsed[key] = len(self._pending)
+            self._pending.append((consumer, data))
+
+    def _drain(self) -> None:
+        with self._lock:
+            pending, self._pending, self._collapsed = self._pending, [], {}
+        for consumer, data in pending:
+            start = perf_counter()
+            try:
+                consumer(data)
+            except Exception:
+                print("Exception in UIBridge")
+                print_exc()
+            if STATS.enabled:
+                STATS.record('ui', subscriber_name(consumer), perf_counter() - start)
+        self._root.after(self.FRAME_MS, self._drain)
+
+def increasing_run(values: List[int]) -> set:
+    # the values of a longest increasing subsequence of values
+    tails, tail_at, previous = [], [], [None] * len(values)
+    for i, value in enumerate(values):
+        j = bisect_left(tails, value)
+        if j:
+            previous[i] = tail_at[j - 1]
+        if j == len(tails):
+            tails.append(value)
+            tail_at.append(i)
+        else:
+            tails[j] = value
+            tail_at[j] = i
+    run = set()
+    i = tail_at[-1] if tail_at else None
+    while i is not None:
+        run.add(values[i])
+        i = previous[i]
+    return run
+
+def bridge(widget: tk.Misc) -> UIBridge:
+    return widget.nametowidget('.').bridge
+
 class UI(tk.Tk):
     def __init__(self, *args, **kwargs):
         print('creating main window')
         super().__init__(*args, **kwargs)
-        self.events = GlobalEvents.get_event_system()
+        self.bridge = UIBridge(self, GlobalEvents.get_event_system())
+        self.events = self.bridge
+        self.clipboard = TkClipboard(self)
         self._ui = NestedPropertiesDict()
         self._init_menus()
         self._init_frames()
@@ -39,6 +121,13 @@ class UI(tk.Tk):
         self.events.subscribe(Event.MENU_ADD_TOTP, self.handle_add_totp)
         self.events.subscribe(Event.SHOW_TOTP_FRAME, self.handle_show_totp_frame)
         self.events.subscribe(Event.MENU_CHANGE_PASSWORD, self.handle_change_password)
+        self.events.subscribe(Event.CLIPBOARD_COPY, self.clipboard.copy)
+        self.events.subscribe(Event.KEYFILE_WRITE_FAILED, self.handle_write_failed)
+
+    def destroy(self) -> None:
+        # don't leave a code behind on platforms where the clipboard outlives us
+        self.clipboard.close()
+        super().destroy()
 
     def handle_totp_list(self, *args, **kwargs) -> None:
         self.show_frame(self._ui.frame.totps)
@@ -52,6 +141,10 @@ class UI(tk.Tk):
     def handle_change_password(self, *args, **kwargs) -> None:
         self.show_frame(self._ui.frame.password)
 
+    def handle_write_failed(self, failure: Tuple[str, str]) -> None:
+        vault_name, error = failure
+        messagebox.showerror(title="Could not save", message=f'Changes to "{vault_name}" could not be saved: {error}\nThey are kept and will be retried.')
+
     def show_frame(self, frame:ttk.Frame):
         for f in self._ui.frame.values():
             f.hide()
@@ -65,7 +158,7 @@ class _MenuBar(tk.Menu):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         print('creating menus')
-        self.events = GlobalEvents.get_event_system()
+        self.events = bridge(self)
         self.menu = NestedPropertiesDict()
         self.menu.file = tk.Menu(self, tearoff=0)
         self.menu.file.add_command(label="Change Password", command=lambda: self.events.publish(Event.MENU_CHANGE_PASSWORD))
@@ -86,7 +179,7 @@ class _MenuBar(tk.Menu):
 class _PasswordFrame(ttk.Frame):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.events = GlobalEvents.get_event_system()
+        self.events = bridge(self)
         self._ui = NestedPropertiesDict()
         self._ui.var.password = StringVar()
         self._ui.password.label = ttk.Label(self, font=('TkDefaultFont', 20), text="Password")
@@ -95,23 +188,142 @@ class _PasswordFrame(ttk.Frame):
         self._ui.password.entry.bind('<Return>', self._password_entered)
         self._ui.password.entry.pack(padx=8, pady=8)
         self._ui.password.entry.focus_set()
+        self._ui.var.status = StringVar()
+        self._ui.status.label = ttk.Label(self, textvariable=self._ui.var.status, wraplength=224, justify=tk.CENTER)
+        self._ui.status.label.pack(pady=4)
+        self._locked = []
+        self.events.subscribe(Event.UNLOCK_PROGRESS, self.update_progress)
 
     def _password_entered(self, event: tk.Event) -> None:
+        self._locked = []
+        self._ui.var.status.set("unlocking...")
         self.events.publish(Event.PASSWORD, self._ui.var.password.get())
         self._ui.var.password.set('')
 
+    def update_progress(self, progress: Tuple[str, int, int, bool]) -> None:
+        name, done, total, ok = progress
+        if not ok:
+            self._locked.append(name)
+        if done < total:
+            self._ui.var.status.set(f"unlocking {done}/{total}...")
+        elif len(self._locked) == total:
+            self._ui.var.status.set("wrong password")
+        elif self._locked:
+            self._ui.var.status.set(f"could not unlock {', '.join(self._locked)}")
+        else:
+            self._ui.var.status.set('')
+
     def show(self):
+        self._ui.var.status.set('')
         self.place(relx=0.5, rely=0.45, anchor=tk.CENTER)
 
     def hide(self):
         self.place_forget()
 
-class _TotpsFrame(tk.Frame):
+class _TotpList(ttk.Frame):
+    # Treeview backed so Tk only lays out the rows that are on screen. Updates
+    # are applied as insert/remove diffs and codes are only written into rows
+    # that are currently visible.
     SELECTED_BG = '#aaffaa'
+    STYLE = 'Totps.Treeview'
+
+    def __init__(self, *args, on_select: Callable[[str], None] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_select = on_select
+        self._names = []
+        self._codes = {}
+        self._shown = {}
+        self._selected = None
+        style = ttk.Style(self)
+        style.configure(self.STYLE, font=('TkDefaultFont', 16), rowheight=28)
+        style.map(self.STYLE, background=[('selected', self.SELECTED_BG)], foreground=[('selected', 'black')])
+        self._tree = ttk.Treeview(self, columns=('code',), show='tree', selectmode=tk.BROWSE, style=self.STYLE)
+        self._tree.column('#0', stretch=True)
+        self._tree.column('code', width=96, stretch=False, anchor=tk.E)
+        self._scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self._tree.yview)
+        self._tree.configure(yscrollcommand=self._scrolled, cursor='hand2')
+        self._tree.bind('<<TreeviewSelect>>', self._selection_changed)
+        self._tree.bind('<Configure>', lambda e: self._refresh_visible())
+        self._scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self._tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+    @property
+    def selected(self) -> Optional[str]:
+        return self._selected
+
+    def set_names(self, names: List[str]) -> None:
+        wanted = set(names)
+        removed = [name for name in self._names if name not in wanted]
+        if removed:
+            self._tree.delete(*removed)
+            for name in removed:
+                self._shown.pop(name, None)
+        # the tree is in the order of self._names. rows in the longest run that's
+        # already in the new order stay where they are; only the others are
+        # moved, each to just after the row that precedes it in names
+        order = [name for name in self._names if name in wanted]
+        position = {name:i for i, name in enumerate(order)}
+        keep = increasing_run([position[name] for name in names if name in position])
+        for i, name in enumerate(names):
+            existing = name in position
+            if existing and position[name] in keep:
+                continue
+            if existing:
+                order.remove(name)
+            index = order.index(names[i - 1]) + 1 if i else 0
+            order.insert(index, name)
+            if existing:
+                self._tree.move(name, '', index)
+            else:
+                self._tree.insert('', index, iid=name, text=name)
+        self._names = list(names)
+        if self._selected not in wanted:
+            self._selected = None
+        self._refresh_visible()
+
+    def select(self, name: Optional[str]) -> None:
+        self._selected = name
+        if name is None or not self._tree.exists(name):
+            self._tree.selection_set(())
+            return
+        self._tree.selection_set(name)
+        self._tree.see(name)
+
+    def set_codes(self, codes: Dict[str, str]) -> None:
+        self._codes = codes
+        self._refresh_visible()
+
+    def _scrolled(self, first: str, last: str) -> None:
+        self._scrollbar.set(first, last)
+        self._refresh_visible()
+
+    def _visible_names(self) -> List[str]:
+        # from the top row on screen down to the first one without a bbox
+        names = []
+        name = self._tree.identify_row(1)
+        while name and self._tree.bbox(name):
+            names.append(name)
+            name = self._tree.next(name)
+        return names
+
+    def _refresh_visible(self) -> None:
+        for name in self._visible_names():
+            code = self._codes.get(name, '')
+            if self._shown.get(name) != code:
+                self._tree.set(name, 'code', code)
+                self._shown[name] = code
+
+    def _selection_changed(self, event: tk.Event) -> None:
+        name = first(self._tree.selection())
+        if name is not None and name != self._selected:
+            self._selected = name
+            if self._on_select:
+                self._on_select(name)
 
+class _TotpsFrame(tk.Frame):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.events = GlobalEvents.get_event_system()
+        self.events = bridge(self)
         self._ui = NestedPropertiesDict()
         self._ui.totp.frame = tk.Frame(self)
         self._ui.totp.frame.pack(fill=tk.X, expand=False)
@@ -124,11 +336,21 @@ class _TotpsFrame(tk.Frame):
         self._ui.totp.progress.pack(fill=tk.X, padx=8, pady=4)
         self._ui.separator = ttk.Separator(self)
         self._ui.separator.pack(fill=tk.X, pady=8)
-        self._ui.list.frame = tk.Frame(self)
-        self._ui.list.frame.pack(fill=tk.BOTH, expand=True, pady=8)
-        self._ui.list.labels = []
+        self._ui.var.filter = StringVar()
+        self._ui.var.filter.trace_add('write', lambda *args: self.apply_filter())
+        self._ui.filter.entry = ttk.Entry(self, textvariable=self._ui.var.filter)
+        self._ui.filter.entry.pack(fill=tk.X, padx=8)
+        self._ui.list = _TotpList(self, on_select=self._totp_clicked)
+        self._ui.list.pack(fill=tk.BOTH, expand=True, pady=8)
+        # looked up on every TOTP_UPDATE / TIMER_UPDATE, resolved once here
+        self._name_label = PropertyHandle(self._ui, 'totp.name.label')
+        self._token_label = PropertyHandle(self._ui, 'totp.token.label')
+        self._progress = PropertyHandle(self._ui, 'totp.progress')
+        self.totps = []
+        self._index = NameIndex()
 
         self.events.subscribe(Event.TOTP_LIST, self.set_totp_list)
+        self.events.subscribe(Event.TOTP_CODES, self.set_totp_codes)
         self.events.subscribe(Event.TOTP_UPDATE, self.update_totp)
         self.events.subscribe(Event.TIMER_UPDATE, self.update_timer)
         self.events.subscribe(Event.MENU_REMOVE_TOTP, self.handle_menu_remove_totp)
@@ -136,39 +358,42 @@ class _TotpsFrame(tk.Frame):
 
     def set_totp_list(self, totps: List) -> None:
         self.totps = totps
-        for l in self._ui.list.labels:
-            l.destroy()
-        self._ui.list.labels = []
-        for name in totps:
-            l = ttk.Label(self._ui.list.frame, font=('TkDefaultFont', 16), cursor='hand2', text=name)
-            l.bind('<Button-1>', partial(self._totp_clicked, name))
-            l.pack(fill=tk.X)
-            self._ui.list.labels.append(l)
+        # the list the application published is the only source for the index;
+        # sync only touches the names that changed
+        self._index.sync(totps)
+        self.apply_filter()
         self.select_totp(first(totps))
 
+    def apply_filter(self) -> None:
+        pattern = self._ui.var.filter.get().strip()
+        self._ui.list.set_names(self._index.search(pattern) if pattern else self.totps)
+        if self._ui.list.selected is None:
+            self.select_totp(None)
+
+    def set_totp_codes(self, codes: Dict[str, str]) -> None:
+        self._ui.list.set_codes(codes)
+
     def select_totp(self, name: str) -> None:
-        for l in self._ui.list.labels:
-            l['background'] = ''
-            if l['text'] == name:
-                l['background'] = self.SELECTED_BG
+        self._ui.list.select(name)
 
-    def update_totp(self, totp: Tuple[str, TOTP]) -> None:
-        self._ui.totp.name.label['text'] = totp[0]
-        self._ui.totp.token.label['text'] = totp[1]
+    def update_totp(self, totp: Tuple[str, str]) -> None:
+        self._name_label.get()['text'] = totp[0]
+        self._token_label.get()['text'] = totp[1]
 
     def update_timer(self, percent: float) -> None:
-        self._ui.totp.progress['value'] = percent * 100.0
+        self._progress.get()['value'] = percent * 100.0
 
     def handle_menu_remove_totp(self, *args, **kwargs) -> None:
-        totp_name = first([w['text'] for w in self._ui.list.labels if str(w['background']) == self.SELECTED_BG])
+        totp_name = self._ui.list.selected
+        if totp_name is None:
+            return
         if messagebox.askyesno(title="Delete TOTP", message=f'Delete "{totp_name}", are you sure? This can not be undone!'):
             self.events.publish(Event.REMOVE_TOTP, totp_name)
 
     def handle_show_totp(self, totp: Tuple[str, str], *args, **kwargs) -> None:
         messagebox.showinfo(title=f"{totp[0]}", message=totp[1])
 
-    def _totp_clicked(self, name: str, event: tk.Event) -> None:
-        self.select_totp(name)
+    def _totp_clicked(self, name: str) -> None:
         self.events.publish(Event.TOTP_SELECTED, name)
 
     def show(self) -> None:
@@ -180,7 +405,7 @@ class _TotpsFrame(tk.Frame):
 class _AddTotpFrame(tk.Frame):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.events = GlobalEvents.get_event_system()
+        self.events = bridge(self)
         self._ui = NestedPropertiesDict()
         self._ui.var.name = StringVar()
         self._ui.var.secret = StringVar()
@@ -0,0 +1,245 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from threading import RLock
+from traceback import print_exc
+from typing import Callable, Dict, List, Optional, Tuple
+
+from toki.codes import Entry
+from toki.keyfile import CanNotDecrypt, JournaledKeyFile, diff_keys
+from toki.persist import KeyFileWriter
+
+# entries of a multi-vault session are named <vault>/<name>
+NAMESPACE_SEPARATOR = '/'
+
+class Vault:
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.keyfile = None
+        self.keys = {}
+        self.writer = None
+        # cleared when the keyfile changes under a password we don't have
+        self.watched = True
+
+    @property
+    def unlocked(self) -> bool:
+        return self.keyfile is not None
+
+# Several keyfiles opened with one passphrase and presented as a single vault.
+# With one keyfile entry names are left as they are; with more, each is prefixed
+# by its vault's name (the keyfile's basename) so they can't collide, and edits
+# are routed back by that prefix.
+#
+# Without a source the set keeps each vault's entries itself. With one (e.g.
+# CodeEngine.entries) the entries read at unlock are handed to unlock()'s load
+# (or entries()) and dropped, and whatever has to be written is taken from the
+# source at write time, so no second copy of the secrets is kept for the session.
+# That's only safe because a vault counts as unlocked once load has succeeded.
+class VaultSet:
+    def __init__(self, paths: List[str], create_file: bool = False, format: Optional[str] = None, kdf: Optional[dict] = None, write_behind: bool = False, source: Optional[Callable[[], Dict[str, Entry]]] = None, on_write_error: Optional[Callable[[str, Exception], None]] = None):
+        self.vaults: Dict[str, Vault] = {name:Vault(name, path) for name, path in zip(vault_names(paths), paths)}
+        self._create_file = create_file
+        self._format = format
+        self._kdf = kdf
+        # edits go through a KeyFileWriter per vault instead of straight to the keyfile
+        self._write_behind = write_behind
+        # on_write_error(vault name, exception) when a writer's edits couldn't be saved
+        self._on_write_error = on_write_error
+        self._source = source
+        # update/reload run on the event thread while rekey runs on the unlock thread
+        self._lock = RLock()
+
+    def __len__(self) -> int:
+        return len(self.vaults)
+
+    @property
+    def namespaced(self) -> bool:
+        return len(self.vaults) > 1
+
+    @property
+    def unlocked(self) -> List[Vault]:
+        return [v for v in self.vaults.values() if v.unlocked]
+
+    # progress(vault name, vaults done, vault count, unlocked) is called from the
+    # caller's thread as each vault finishes; returns the vaults that stayed locked.
+    # load(entries) gets every unlocked vault's entries before any of it is
+    # committed; if it raises, nothing is unlocked and the exception propagates
+    def unlock(self, passphrase: str, progress: Optional[Callable[[str, int, int, bool], None]] = None, load: Optional[Callable[[Dict[str, Entry]], None]] = None) -> List[str]:
+        locked = []
+        opened: Dict[str, Tuple[JournaledKeyFile, dict]] = {}
+        # the KDF in cryptography runs without the GIL, so threads are enough to
+        # derive every vault's key at once
+        with ThreadPoolExecutor(len(self.vaults) or 1, thread_name_prefix='unlock') as pool:
+            futures = {pool.submit(self._open, vault, passphrase):vault for vault in self.vaults.values()}
+            for done, future in enumerate(as_completed(futures), 1):
+                vault = futures[future]
+                try:
+                    opened[vault.name] = future.result()
+                except CanNotDecrypt:
+                    locked.append(vault.name)
+                except Exception:
+                    # a corrupt keyfile stays locked like one with another password
+                    print(f"Exception opening {vault.path}")
+                    print_exc()
+                    locked.append(vault.name)
+                if progress:
+                    progress(vault.name, done, len(futures), vault.name in opened)
+        # nothing is unlocked until every vault has been tried and loaded
+        with self._lock:
+            if load is not None:
+                try:
+                    load(self._unlocked_entries(opened))
+                except BaseException:
+                    # drop the keys just derived, the vaults stay as they were
+                    for keyfile, _ in opened.values():
+                        keyfile.lock()
+                    raise
+            for name, (keyfile, keys) in opened.items():
+                vault = self.vaults[name]
+                vault.keyfile = keyfile
+                vault.keys = {} if load is not None and self._source is not None else keys
+                if self._write_behind:
+                    vault.writer = vault.writer or self._writer(vault)
+        return locked
+
+    def _open(self, vault: Vault, passphrase: str) -> Tuple[JournaledKeyFile, dict]:
+        create = self._create_file or not os.path.isfile(vault.path)
+        keyfile = JournaledKeyFile(vault.path, passphrase, create_file=create, format=self._format, kdf=self._kdf)
+        return keyfile, keyfile.read_keys()
+
+    def _unlocked_entries(self, opened: Dict[str, Tuple[JournaledKeyFile, dict]]) -> Dict[str, Entry]:
+        # what entries() will be once opened is committed
+        entries = {}
+        for vault in self.vaults.values():
+            if vault.name in opened:
+                keys = opened[vault.name][1]
+            elif vault.unlocked:
+                keys = self._vault_keys(vault)
+            else:
+                continue
+            entries.update((self.qualify(vault.name, name), entry) for name, entry in keys.items())
+        return entries
+
+    def _writer(self, vault: Vault) -> KeyFileWriter:
+        on_error = partial(self._on_write_error, vault.name) if self._on_write_error else None
+        return KeyFileWriter(vault.keyfile, on_error)
+
+    def entries(self) -> Dict[str, Entry]:
+        entries = {self.qualify(vault.name, name):entry for vault in self.unlocked for name, entry in vault.keys.items()}
+        if self._source is not None:
+            # the source holds them from here on
+            for vault in self.vaults.values():
+                vault.keys = {}
+        return entries
+
+    def _vault_keys(self, vault: Vault) -> Dict[str, Entry]:
+        # one vault's entries under their local names
+        if self._source is None:
+            return vault.keys
+        prefix = self.qualify(vault.name, '')
+        return {name[len(prefix):]:entry for name, entry in self._source().items() if name.startswith(prefix)}
+
+    def qualify(self, vault_name: str, name: str) -> str:
+        return f"{vault_name}{NAMESPACE_SEPARATOR}{name}" if self.namespaced else name
+
+    def locate(self, name: str) -> Tuple[Vault, str]:
+        # unprefixed names belong to the first unlocked vault
+        unlocked = self.unlocked
+        if not unlocked:
+            raise KeyError("no vault is unlocked")
+        if self.namespaced:
+            vault_name, sep, local = name.partition(NAMESPACE_SEPARATOR)
+            vault = self.vaults.get(vault_name)
+            if sep and vault is not None and vault.unlocked:
+                return vault, local
+        return unlocked[0], name
+
+    def update(self, changes: List[Tuple[str, Optional[Entry]]]) -> List[str]:
+        with self._lock:
+            return self._update(changes)
+
+    def _update(self, changes: List[Tuple[str, Optional[Entry]]]) -> List[str]:
+        # same (name, entry) / (name, None) changes as KeyFile.update_keys, one write
+        # per vault touched; returns the qualified names
+        per_vault: Dict[str, List[Tuple[str, Optional[Entry]]]] = {}
+        names = []
+        for name, entry in changes:
+            vault, local = self.locate(name)
+            if self._source is None:
+                if entry is None:
+                    vault.keys.pop(local, None)
+                else:
+                    vault.keys[local] = entry
+            per_vault.setdefault(vault.name, []).append((local, entry))
+            names.append(self.qualify(vault.name, local))
+        for vault_name, vault_changes in per_vault.items():
+            vault = self.vaults[vault_name]
+            if vault.writer:
+                # the writer asks for the entries when it writes, not now
+                vault.writer.update_keys(partial(self._vault_keys, vault), vault_changes)
+            else:
+                vault.keyfile.update_keys(self._vault_keys(vault), vault_changes)
+        return names
+
+    def changed(self) -> List[str]:
+        # vaults another process has written to since we last read them
+        return [vault.name for vault in self.unlocked if vault.watched and vault.keyfile.changed()]
+
+    def reload(self, vault_name: str) -> List[Tuple[str, Optional[Entry]]]:
+        with self._lock:
+            return self._reload(vault_name)
+
+    def _reload(self, vault_name: str) -> List[Tuple[str, Optional[Entry]]]:
+        # re-reads one vault with its cached key and returns what changed, as
+        # qualified (name, entry) / (name, None) changes
+        vault = self.vaults[vault_name]
+        if vault.writer:
+            # our own pending edits have to be on disk first or they'd diff as removed
+            vault.writer.flush()
+        try:
+            keys = vault.keyfile.read_keys()
+        except CanNotDecrypt:
+            vault.watched = False
+            raise
+        changes = diff_keys(self._vault_keys(vault), keys)
+        if self._source is None:
+            vault.keys = keys
+        return [(self.qualify(vault.name, name), entry) for name, entry in changes]
+
+    def rekey(self, passphrase: str) -> None:
+        # rewrites every unlocked vault under the new passphrase. edits wait until
+        # it's done and then go to the new keyfile
+        with self._lock:
+            for vault in self.unlocked:
+                if vault.writer:
+                    vault.writer.stop()
+                # rewrap writes the new salt and contents in a single replace, so
+                # other instances never see an empty vault in between
+                keyfile = JournaledKeyFile(vault.path, passphrase, format=vault.keyfile.format)
+                keyfile.rewrap(self._vault_keys(vault), vault.keyfile.kdf)
+                vault.keyfile = keyfile
+                if vault.writer:
+                    vault.writer = self._writer(vault)
+
+    def stop(self) -> None:
+        # also waits for journal compaction, which runs on a daemon thread a
+        # short-lived process would otherwise kill on exit
+        with self._lock:
+            for vault in self.unlocked:
+                if vault.writer:
+                    vault.writer.stop()
+                else:
+                    vault.keyfile.flush()
+                vault.keys = {}
+
+def vault_names(paths: List[str]) -> List[str]:
+    # ~/keys/team-a.keys -> team-a, with a suffix when two basenames are the same
+    names = []
+    for path in paths:
+        base = os.path.splitext(os.path.basename(os.path.expanduser(path)))[0].lstrip('.') or 'vault'
+        name, n = base, 2
+        while name in names:
+            name, n = f"{base}-{n}", n + 1
+        names.append(name)
+    return names
@@ -0,0 +1,119 @@
+import hmac
+from struct import pack
+from threading import Lock
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from toki.codes import Entry, decode_entry, truncate
+from toki.instrument import timed
+from toki.keyfile import KeyFile
+
+DEFAULT_WINDOW = 1
+
+# Checks submitted codes against many users' secrets, server side.
+# A code is accepted if it matches any step within +-window of now and that step
+# is later than the last one accepted for the user (RFC 6238 section 5.2), so a
+# code can't be replayed, not even within its own step.
+class Verifier:
+    def __init__(self, secrets: Optional[Dict[str, Entry]] = None, window: int = DEFAULT_WINDOW, last_steps: Optional[Dict[str, int]] = None):
+        self.window = window
+        self._keys: Dict[str, Tuple[bytes, int, int, str]] = {}
+        # name -> last accepted step; pass last_steps back in to keep replay
+        # protection across restarts
+        self._last_steps: Dict[str, int] = dict(last_steps or {})
+        # (period, step) -> {name: code}, filled in for whoever is asked about
+        self._cache: Dict[Tuple[int, int], Dict[str, str]] = {}
+        self._lock = Lock()
+        if secrets:
+            self.set_secrets(secrets)
+
+    @classmethod
+    def from_keyfile(cls, keyfile: KeyFile, window: int = DEFAULT_WINDOW) -> 'Verifier':
+        return cls(keyfile.read_keys(), window)
+
+    def set_secrets(self, secrets: Dict[str, Entry]) -> None:
+        keys = {name:decode_entry(entry) for name, entry in secrets.items()}
+        with self._lock:
+            self._keys = keys
+            self._cache.clear()
+
+    def add(self, name: str, entry: Entry) -> None:
+        key = decode_entry(entry)
+        with self._lock:
+            self._keys[name] = key
+            for codes in self._cache.values():
+                codes.pop(name, None)
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            self._keys.pop(name, None)
+            self._last_steps.pop(name, None)
+            for codes in self._cache.values():
+                codes.pop(name, None)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def last_steps(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._last_steps)
+
+    def verify(self, name: str, code: str, for_time: Optional[float] = None) -> bool:
+        return self.verify_many([(name, code)], for_time)[0]
+
+    @timed('verify', 'batch')
+    def verify_many(self, attempts: Iterable[Tuple[str, str]], for_time: Optional[float] = None) -> List[bool]:
+        # attempts are checked in order, so a repeated (name, code) in the same
+        # batch is rejected just like a replay across calls
+        now = time() if for_time is None else for_time
+        attempts = list(attempts)
+        with self._lock:
+            steps = self._candidate_steps([name for name, _ in attempts], now)
+            return [self._check(name, code, steps.get(name, ())) for name, code in attempts]
+
+    def _candidate_steps(self, names: List[str], now: float) -> Dict[str, Tuple[Tuple[int, int], ...]]:
+        # works out every (period, step) the batch needs and computes the missing
+        # codes for them in one go, one counter encoding per step
+        candidates = {}
+        missing: Dict[Tuple[int, int], List[str]] = {}
+        for name in names:
+            key = self._keys.get(name)
+            if key is None or name in candidates:
+                continue
+            period = key[2]
+            current = int(now // period)
+            candidates[name] = tuple((period, step) for step in range(current - self.window, current + self.window + 1))
+            for period_step in candidates[name]:
+                if name not in self._cache.get(period_step, ()):
+                    missing.setdefault(period_step, []).append(name)
+        digest = hmac.digest
+        for period_step, step_names in missing.items():
+            counter = pack('>Q', period_step[1])
+            codes = self._cache.setdefault(period_step, {})
+            for name in step_names:
+                key, digits, _, alg = self._keys[name]
+                codes[name] = truncate(digest(key, counter, alg), digits)
+        self._evict(now)
+        return candidates
+
+    def _evict(self, now: float) -> None:
+        for period, step in [ps for ps in self._cache if ps[1] < int(now // ps[0]) - self.window]:
+            del self._cache[(period, step)]
+
+    def _check(self, name: str, code: str, steps: Tuple[Tuple[int, int], ...]) -> bool:
+        if not steps or not isinstance(code, str) or not code.isascii():
+            return False
+        code = code.replace(' ', '')
+        last = self._last_steps.get(name)
+        matched = None
+        # every candidate is compared, so timing doesn't depend on which one matched
+        for period, step in steps:
+            if hmac.compare_digest(self._cache[(period, step)][name], code) and (last is None or step > last):
+                matched = step
+        if matched is None:
+            return False
+        self._last_steps[name] = matched
+        return True
@@ -1,15 +1,24 @@
 #!/usr/bin/python3
 
+import atexit
+import json
 import os
 import time
 import sys
 from argparse import ArgumentParser
 from math import floor
-from pyotp import TOTP
 from time import sleep
 from getpass import getpass
+from typing import List
 
-from toki.keyfile import KeyFile
+from toki.agent import DEFAULT_IDLE_TIMEOUT, Agent, AgentError, AgentUnavailable, agent_request
+from toki.codes import CodeEngine, compact_entry
+from toki import otpauth
+from toki.instrument import STATS
+from toki.keyfile import DEFAULT_KDFS, FORMATS, KDF_PBKDF2_SHA256, KDFS, CanNotDecrypt, calibrate_kdf, convert_keyfile, describe_kdf
+from toki.search import NameIndex
+from toki.term import TerminalRenderer
+from toki.vaults import VaultSet
 
 DEFAULT_KEYFILE = './.totp.keys'
 
@@ -17,44 +26,186 @@ def parse_args():
     ap = ArgumentParser(description="One Time Pads")
     ap.add_argument('-a', dest="name", metavar="name", help="add an OTP")
     ap.add_argument('-p', action="store_true", dest="private", help="disable local echo for the key prompt when adding a key")
-    ap.add_argument('-k', dest="keyfile", default=DEFAULT_KEYFILE, metavar="keyfile", help=f"keyfile to use (default: {DEFAULT_KEYFILE}")
+    ap.add_argument('-k', dest="keyfiles", action="append", metavar="keyfile", help=f"keyfile to use, repeat to open several at once as <keyfile name>/<otp name> (default: {DEFAULT_KEYFILE})")
     ap.add_argument('-c', action="store_true", dest="create", help="Create new OTP keyfile. This will overwrite existing <keyfile>")
+    ap.add_argument('-s', dest="search", metavar="pattern", help="only show OTPs whose name matches <pattern> (prefix or fuzzy)")
+    ap.add_argument('--once', action="store_true", dest="once", help="print the current codes once and exit")
+    ap.add_argument('--json', action="store_true", dest="json", help="print the current codes once as JSON and exit")
+    ap.add_argument('-n', dest="code_name", metavar="name", help="print the current code for <name>, via the agent if one is running")
+    ap.add_argument('-l', action="store_true", dest="list", help="list OTP names, via the agent if one is running")
+    ap.add_argument('--agent', action="store_true", dest="agent", help="unlock <keyfile> once and serve codes over a Unix socket")
+    ap.add_argument('--lock', action="store_true", dest="lock", help="tell a running agent to forget its keys and exit")
+    ap.add_argument('--idle', dest="idle", type=float, default=DEFAULT_IDLE_TIMEOUT, metavar="seconds", help=f"agent locks itself after <seconds> without requests (default: {DEFAULT_IDLE_TIMEOUT})")
+    ap.add_argument('--socket', dest="socket", metavar="path", help="agent socket path (default: $TOKI_AGENT_SOCK or $XDG_RUNTIME_DIR/toki-agent-<uid>.sock)")
+    ap.add_argument('--import', dest="import_file", metavar="file", help="add every entry in <file> (- for stdin) in a single write")
+    ap.add_argument('--export', dest="export_file", metavar="file", help="write every entry to <file> (- for stdout)")
+    ap.add_argument('--io-format', dest="io_format", choices=otpauth.FORMATS, default=otpauth.FORMAT_URI, help="format for --import/--export: otpauth:// URIs one per line, CSV, or JSON lines (default: uri)")
+    ap.add_argument('--stats', action="store_true", dest="stats", help="record timings (as TOKI_STATS=1 does) and print them to stderr on exit")
+    ap.add_argument('-f', dest="format", choices=FORMATS, help="keyfile format to create with -c (default: json)")
+    ap.add_argument('--kdf', dest="kdf", choices=KDFS, help=f"key derivation for -c, or to re-wrap <keyfile> with (default: keep the current one, {KDF_PBKDF2_SHA256} for new files)")
+    ap.add_argument('--calibrate', dest="calibrate", type=float, metavar="seconds", help="pick --kdf parameters that take about <seconds> to unlock on this machine and re-wrap <keyfile> with them")
+    ap.add_argument('--convert', dest="convert", choices=FORMATS, metavar="format", help=f"convert <keyfile> to another format ({', '.join(FORMATS)})")
     return ap.parse_args()
 
+def otp_lines(engine: CodeEngine, width: int, now: float) -> List[str]:
+    lines = [f"{name:{width}}: " + code for (name, code) in engine.codes(now).items()]
+    ttl = floor(now) % engine.interval
+    lines.append('[' + ('|' * ttl) + ("-" * (engine.interval - 1 - ttl)) + ']')
+    return lines
+
+def load_engine(keys) -> CodeEngine:
+    engine = CodeEngine()
+    for name in engine.set_secrets(keys):
+        print(f"skipping {name}: not a valid secret", file=sys.stderr)
+    return engine
+
 def otp_loop(keys):
-    otps = {name:TOTP(key) for (name, key) in keys.items()}
-    width = max(map(lambda x: len(x), keys.keys())) + 1
-    while True:
-        os.system("clear")
-        for (name, otp) in otps.items():
-            print(f"{name:{width}}: " + otp.now())
-        ttl = floor(time.time()) % 30
-        print('[' + ('|' * ttl) + ("-" * (29 - ttl)) + ']')
-        sleep(1)
+    engine = load_engine(keys)
+    width = max(map(lambda x: len(x), keys.keys()), default=0) + 1
+    renderer = TerminalRenderer()
+    try:
+        while True:
+            now = time.time()
+            renderer.render(otp_lines(engine, width, now))
+            # wake on the next whole second, which is when the bar moves
+            sleep(1 - now % 1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        renderer.close()
+        engine.zeroize()
+
+def otp_once(keys, as_json=False):
+    engine = load_engine(keys)
+    now = time.time()
+    if as_json:
+        print(json.dumps({name:{'code': code, 'remaining': engine.remaining(now, engine.period(name))} for name, code in engine.codes(now).items()}))
+    else:
+        width = max(map(lambda x: len(x), keys.keys()), default=0) + 1
+        print('\n'.join(otp_lines(engine, width, now)[:-1]))
+
+
+
+def import_entries(vaults, filename, format):
+    with (sys.stdin if filename == '-' else open(filename, newline='')) as f:
+        changes = list(otpauth.read_entries(f, format))
+    vaults.update(changes)
+    vaults.stop()
+    print(f"imported {len(changes)} OTPs")
 
+def export_entries(keys, filename, format):
+    with (sys.stdout if filename == '-' else open(filename, 'w', newline='')) as f:
+        count = otpauth.write_entries(f, keys.items(), format)
+    if filename != '-':
+        print(f"exported {count} OTPs")
 
+def agent_client(args) -> bool:
+    # returns False when no agent is reachable so the caller can use the keyfile directly
+    try:
+        if args.lock:
+            agent_request({'op': 'lock'}, args.socket)
+        elif args.list:
+            print('\n'.join(agent_request({'op': 'list'}, args.socket)['names']))
+        else:
+            print(agent_request({'op': 'code', 'name': args.code_name}, args.socket)['code'])
+    except AgentUnavailable:
+        return False
+    except AgentError as ex:
+        print(f"agent: {ex}")
+        sys.exit(-4)
+    return True
 
 if __name__ == '__main__':
     args = parse_args()
-    if not os.path.isfile(os.path.expanduser(args.keyfile)) and not args.create:
-        print(f"keyfile {args.keyfile} does not exist. use -c to create new")
+    if args.stats:
+        STATS.enabled = True
+        atexit.register(STATS.dump)
+    if (args.lock or args.list or args.code_name) and agent_client(args):
+        sys.exit(0)
+    if args.lock:
+        print("no agent running")
+        sys.exit(-4)
+
+    keyfiles = args.keyfiles or [DEFAULT_KEYFILE]
+    if len(keyfiles) > 1 and (args.agent or args.convert):
+        print("--agent and --convert take a single keyfile")
         sys.exit(-1)
+    for keyfile in keyfiles:
+        if not os.path.isfile(os.path.expanduser(keyfile)) and not args.create:
+            print(f"keyfile {keyfile} does not exist. use -c to create new")
+            sys.exit(-1)
 
     passphrase = getpass()
 
-    kf = KeyFile(args.keyfile, passphrase, create_file=args.create)
-    try:
-        keys = kf.read_keys()
-    except InvalidTag:
+    if args.convert:
+        try:
+            convert_keyfile(keyfiles[0], passphrase, args.convert)
+        except CanNotDecrypt:
+            print("could not decrypt key data. probably bad password")
+            sys.exit(-2)
+        sys.exit(0)
+
+    kdf = None
+    if args.calibrate:
+        kdf = calibrate_kdf(args.calibrate, args.kdf or KDF_PBKDF2_SHA256)
+    elif args.kdf:
+        kdf = DEFAULT_KDFS[args.kdf]
+
+    # several keyfiles are unlocked concurrently, each costs about one KDF of wall time
+    vaults = VaultSet(keyfiles, create_file=args.create, format=args.format, kdf=kdf)
+    locked = vaults.unlock(passphrase)
+    if len(locked) == len(vaults):
         print("could not decrypt key data. probably bad password")
         sys.exit(-2)
+    for name in locked:
+        print(f"could not decrypt {vaults.vaults[name].path}, skipping it", file=sys.stderr)
+    keys = vaults.entries()
 
-    if args.name is not None:
+    if args.calibrate:
+        for vault in vaults.unlocked:
+            print(f"{vault.path} now uses {describe_kdf(vault.keyfile.kdf)}")
+        sys.exit(0)
+
+    if args.agent:
+        try:
+            Agent(vaults.unlocked[0].keyfile, args.socket, args.idle).run()
+        except AgentError as ex:
+            print(ex)
+            sys.exit(-4)
+    elif args.list:
+        print('\n'.join(keys))
+    elif args.code_name is not None:
+        if args.code_name not in keys:
+            print(f"no such OTP {args.code_name}")
+            sys.exit(-3)
+        engine = CodeEngine({args.code_name: keys[args.code_name]})
+        if args.code_name not in engine:
+            print(f"{args.code_name} is not a valid secret")
+            sys.exit(-3)
+        print(engine.code(args.code_name))
+    elif args.import_file:
+        try:
+            import_entries(vaults, args.import_file, args.io_format)
+        except otpauth.InvalidEntry as ex:
+            print(f"import failed, nothing was written: {ex}")
+            sys.exit(-3)
+    elif args.export_file:
+        export_entries(keys, args.export_file, args.io_format)
+    elif args.name is not None:
         if args.private:
             key = getpass()
         else:
             key = input("key: ")
-        keys[args.name] = key
-        kf.write_keys(keys)
+        entry = otpauth.parse_uri(key)[1] if key.startswith('otpauth://') else compact_entry(key)
+        vaults.update([(args.name, entry)])
+        vaults.stop()
     else:
-        otp_loop(keys)
+        if args.search:
+            keys = {name:keys[name] for name in NameIndex(keys).search(args.search)}
+            if not keys:
+                print(f"no OTPs match {args.search}")
+                sys.exit(-3)
+        if args.once or args.json:
+            otp_once(keys, as_json=args.json)
+        else:
+            otp_loop(keys)